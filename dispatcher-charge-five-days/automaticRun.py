@@ -1,13 +1,43 @@
 import subprocess
 import os
+import sys
+import time
+from datetime import datetime
+from dotenv import load_dotenv
 
-def run_script(script_name):
+import budget
+import run_lock
+import storage
+
+def run_script(script_name, extra_args=(), lease=None):
     script_path = os.path.join(base_dir, script_name)
-    try:
-        result = subprocess.run(['python3', script_path], check=True)
+    started = time.perf_counter()
+    process = subprocess.Popen(['python3', script_path, *extra_args])
+    while True:
+        try:
+            returncode = process.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            # Outra instância assumiu o lock (lease vencido): para a etapa para não processar os mesmos contatos
+            if lease is not None and lease.lost.is_set():
+                process.terminate()
+                returncode = process.wait()
+                break
+    if returncode == 0:
         print(f"{script_name} executed successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error occurred while executing {script_name}: {e}")
+    else:
+        print(f"Error occurred while executing {script_name}: exit status {returncode}")
+    return time.perf_counter() - started
+
+def save_profile_summary(timings):
+    # Tempo total de cada etapa; o detalhamento de cada uma fica em perfil/<etapa>-*
+    profile_dir = os.path.join(base_dir, 'perfil')
+    os.makedirs(profile_dir, exist_ok=True)
+    summary_file = os.path.join(profile_dir, f"automaticRun-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    storage.write_json(summary_file, {'wall_seconds': timings, 'total_seconds': sum(timings.values())})
+    for script_name, seconds in timings.items():
+        print(f"{script_name}: {seconds:.2f}s")
+    print(f"Profile summary saved to {summary_file}")
 
 # Caminho base (diretório onde este script está localizado)
 base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -15,9 +45,37 @@ base_dir = os.path.dirname(os.path.abspath(__file__))
 # Lista de scripts a serem executados sequencialmente
 scripts = [
     'find_charge.py',
+    'reconcile.py',
     'contact_manager.py',
     'send_mensage.py'
 ]
 
-for script in scripts:
-    run_script(script)
+# RUN_TIME_BUDGET_SECONDS do .env vale para a execução inteira: o prazo é repassado às etapas
+load_dotenv(os.path.join(base_dir, '.env'))
+
+# Repassa --profile / --profile-memory para cada etapa
+profile_args = [arg for arg in sys.argv[1:] if arg in ('--profile', '--profile-memory')]
+# --wait: aguarda a execução em andamento terminar em vez de sair (equivale a RUN_LOCK_WAIT=1)
+wait_for_lock = True if '--wait' in sys.argv[1:] else None
+
+# Uma execução por tenant e bucket de cada vez, também entre máquinas (run_lock.py);
+# os buckets entre si podem rodar em paralelo, ver run_all_buckets.py
+try:
+    with run_lock.hold(wait=wait_for_lock) as lease:
+        run_deadline = budget.deadline_from_now()
+        if run_deadline:
+            os.environ[budget.DEADLINE_ENV] = run_deadline.isoformat()
+
+        timings = {}
+        for script in scripts:
+            if lease.lost.is_set():
+                print("Run lock lost to another instance. Remaining scripts skipped.")
+                break
+            timings[script] = run_script(script, profile_args, lease)
+
+        if profile_args:
+            save_profile_summary(timings)
+except storage.BucketLockedError as e:
+    # Outra instância já está processando o bucket: não é uma falha desta execução
+    print(f"{e}. Execution skipped.")
+    sys.exit(0)
@@ -0,0 +1,29 @@
+import os
+from datetime import datetime, timedelta
+
+# Tempo máximo de uma execução (RUN_TIME_BUDGET_SECONDS no .env; vazio = sem limite).
+# O automaticRun.py repassa o prazo absoluto às etapas em RUN_DEADLINE, para que o limite valha
+# para a execução inteira; uma etapa rodada sozinha conta o tempo a partir do próprio início.
+DEADLINE_ENV = 'RUN_DEADLINE'
+
+_started = datetime.now()
+
+
+def deadline_from_now(now=None):
+    """ Prazo da execução a partir de agora segundo RUN_TIME_BUDGET_SECONDS, ou None """
+    seconds = os.getenv('RUN_TIME_BUDGET_SECONDS', '')
+    if not seconds:
+        return None
+    return (now or datetime.now()) + timedelta(seconds=float(seconds))
+
+
+def deadline():
+    """ Prazo absoluto da execução atual, ou None se não houver limite """
+    if os.getenv(DEADLINE_ENV):
+        return datetime.fromisoformat(os.environ[DEADLINE_ENV])
+    return deadline_from_now(_started)
+
+
+def expired(now=None):
+    limit = deadline()
+    return limit is not None and (now or datetime.now()) >= limit
@@ -2,22 +2,68 @@ import os
 import requests
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+import budget
+import concurrency
+import contact_index
+import dead_letter
+import log_setup
+import metrics
+import negative_cache
+import priority
+import profiling
+import send_history
+import singleflight
+import storage
+import suppression
+import tracing
+from http_client import CircuitOpenError
+from models import Contact, ResolveResult, parse_payments
+from retry import RetryExhaustedError, request_with_retry
+
 # Carrega as variáveis de ambiente a partir do arquivo .env
 load_dotenv()
 
 # Configuração do logger
-logging.basicConfig(level=logging.INFO)
+log_setup.configure()
 logger = logging.getLogger(__name__)
 
 API_URL = 'https://api.sendpulse.com/whatsapp/contacts'
 BOT_ID = os.getenv('BOT_ID')
 VARIABLE_ID_BOLETO = os.getenv('VARIABLE_ID_BOLETO')
 VARIABLE_ID_DUE_DATE = os.getenv('VARIABLE_ID_DUE_DATE')
+# Threads da resolução. Com o controle adaptativo da SendPulse (concurrency.py) o limite efetivo é ajustado
+# em tempo de execução, então o pool só precisa comportar o máximo permitido
+CONTACT_WORKERS = int(os.getenv('CONTACT_WORKERS') or (concurrency.max_concurrency() if concurrency.is_adaptive('sendpulse') else 8))
+# Baixa a lista de contatos do bot antes da resolução e responde as consultas localmente
+PREFETCH_CONTACTS = os.getenv('PREFETCH_CONTACTS', '0') == '1'
+
+# Resultado da resolução de cada boleto
+STATUS_PROCESSED = 'processed'
+STATUS_IGNORED = 'ignored'
+STATUS_FAILED = 'failed'
+STATUS_DEAD_LETTERED = 'dead_lettered'
+STATUS_PARKED = 'parked'
+STATUS_SKIPPED = 'skipped'
+STATUS_SUPPRESSED = 'suppressed'
+
+CONTACTS_FILE = storage.bucket_path('contatos', 'contacts.json')
+IGNORED_FILE = storage.bucket_path('debitos', 'ignored_boletos.json')
+PARKED_FILE = storage.bucket_path('debitos', 'parked_boletos.json')
+FAILED_FILE = storage.bucket_path('debitos', 'failed_boletos.json')
+METRICS_FILE = storage.bucket_path('metricas', 'contact_manager.json')
 
-CONTACTS_FILE = 'dispatcher-charge-five-days/contatos/contacts.json'
-IGNORED_FILE = 'ignored_boletos.json'
+# Respostas que indicam problema no número (ex.: sem WhatsApp) e vão para o cache negativo.
+# As demais (token vencido ou revogado, permissão, erro da requisição) não dizem nada sobre o telefone
+NUMBER_ERROR_STATUS = {400, 422}
+AUTH_ERROR_STATUS = {401, 403}
+
+
+class TokenRejectedError(requests.exceptions.RequestException):
+    """ A SendPulse recusou o token (401/403): as próximas chamadas da execução falhariam do mesmo jeito """
 
 
 def get_access_token(client_id, secret_id):
@@ -25,13 +71,17 @@ def get_access_token(client_id, secret_id):
     headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
     data = {'grant_type': 'client_credentials', 'client_id': client_id, 'client_secret': secret_id}
     
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    try:
+        response = request_with_retry('sendpulse.oauth', 'POST', url, headers=headers, data=json.dumps(data))
+    except requests.exceptions.RequestException as e:
+        logger.error('Erro ao obter o token de acesso: %s', e)
+        return None
     
     if response.status_code == 200:
         return response.json().get('access_token')
     
-    logger.error(f'Erro ao obter o token de acesso. Status code: {response.status_code}')
-    logger.error(f'Resposta da API: {response.text}')
+    logger.error('Erro ao obter o token de acesso. Status code: %s', response.status_code)
+    logger.error('Resposta da API: %s', response.text)
     return None
 
 
@@ -45,23 +95,37 @@ def format_phone_number(phone_number):
 
 
 def check_contact_existence(phone_number, token):
+    # Consulta primeiro o índice local (quando PREFETCH_CONTACTS está ativo)
+    contact_id = contact_index.lookup(phone_number)
+    if contact_id:
+        return contact_id
+    
     headers = {'Accept': 'application/json', 'Authorization': f'Bearer {token}'}
     params = {'phone': phone_number, 'bot_id': BOT_ID}
     
-    response = requests.get(API_URL + '/getByPhone', headers=headers, params=params)
+    try:
+        response = request_with_retry('sendpulse.get_by_phone', 'GET', API_URL + '/getByPhone', headers=headers, params=params)
+    except (CircuitOpenError, RetryExhaustedError):
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.error('Erro ao verificar contato %s: %s', phone_number, e)
+        return None
     
+    if response.status_code in AUTH_ERROR_STATUS:
+        raise TokenRejectedError(f'getByPhone {response.status_code}: token recusado pela SendPulse')
     if response.status_code == 200:
         data = response.json()
         if data.get('success', False) and data.get('data', {}):
             contact_id = data['data']['id']
-            logger.info(f'O número {phone_number} já existe na base. ID: {contact_id}')
+            logger.info('O número %s já existe na base. ID: %s', phone_number, contact_id, extra={'sample': 'contact_exists'})
+            contact_index.add(phone_number, contact_id)
             return contact_id
         return None
     elif response.status_code == 400:
         return None
     else:
-        logger.error(f'Erro ao verificar contato. Status code: {response.status_code}')
-        logger.error(f'Resposta da API: {response.text}')
+        logger.error('Erro ao verificar contato. Status code: %s', response.status_code)
+        logger.error('Resposta da API: %s', response.text)
         return None
 
 
@@ -69,15 +133,29 @@ def create_contact(phone_number, name, bot_id, token):
     headers = {'Accept': 'application/json', 'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
     data = {'phone': phone_number, 'name': name, 'bot_id': bot_id}
     
-    response = requests.post(API_URL, headers=headers, data=json.dumps(data))
+    try:
+        response = request_with_retry('sendpulse.create_contact', 'POST', API_URL, headers=headers, data=json.dumps(data))
+    except (CircuitOpenError, RetryExhaustedError):
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.error('Erro ao criar contato %s: %s', phone_number, e)
+        return None
     
     if response.status_code == 200:
         contact_id = response.json()['id']
-        logger.info(f'Contato criado: {response.json()}')
+        logger.info('Contato criado para %s. ID: %s', phone_number, contact_id, extra={'sample': 'contact_created'})
+        logger.debug('Resposta da API: %s', response.text)
+        contact_index.add(phone_number, contact_id)
         return contact_id
     
-    logger.error(f'Erro ao criar contato. Status code: {response.status_code}')
-    logger.error(f'Resposta da API: {response.text}')
+    if response.status_code in AUTH_ERROR_STATUS:
+        raise TokenRejectedError(f'create_contact {response.status_code}: token recusado pela SendPulse')
+    
+    logger.error('Erro ao criar contato. Status code: %s', response.status_code)
+    logger.error('Resposta da API: %s', response.text)
+    if response.status_code in NUMBER_ERROR_STATUS:
+        # Falha permanente do número (ex.: sem WhatsApp): evita repetir as chamadas nas próximas execuções
+        negative_cache.record_failure(phone_number, f'create_contact {response.status_code}: {response.text[:200]}')
     return None
 
 
@@ -85,24 +163,161 @@ def set_variable(contact_id, variable_id, variable_value, token):
     headers = {'Accept': 'application/json', 'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
     data = {'contact_id': contact_id, 'variable_id': variable_id, 'variable_value': variable_value}
     
-    response = requests.post(API_URL + '/setVariable', headers=headers, data=json.dumps(data))
+    try:
+        response = request_with_retry('sendpulse.set_variable', 'POST', API_URL + '/setVariable', headers=headers, data=json.dumps(data))
+    except (CircuitOpenError, RetryExhaustedError):
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.error('Erro ao definir variável para o contato %s: %s', contact_id, e)
+        return False
     
+    if response.status_code in AUTH_ERROR_STATUS:
+        raise TokenRejectedError(f'setVariable {response.status_code}: token recusado pela SendPulse')
     if response.status_code == 200:
-        logger.info(f'Variável definida com sucesso para o contato {contact_id}. Valor: {variable_value}')
+        logger.info('Variável definida com sucesso para o contato %s. Valor: %s', contact_id, variable_value, extra={'sample': 'set_variable'})
         return True
     
-    logger.error(f'Erro ao definir variável para o contato {contact_id}. Status code: {response.status_code}')
-    logger.error(f'Resposta da API: {response.text}')
+    logger.error('Erro ao definir variável para o contato %s. Status code: %s', contact_id, response.status_code)
+    logger.error('Resposta da API: %s', response.text)
     return False
 
 
 def save_to_json(data, filename):
-    # Garante que a pasta existe antes de salvar o arquivo
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Gravação atômica (cria a pasta se preciso)
+    storage.write_json(filename, data)
+
+
+_contact_lookups = singleflight.Group('contact_lookup')
+
+
+def find_or_create_contact(phone_number, payer_name, token):
+    """ contact_id do telefone, criando o contato se ele não existir. Boletos do mesmo telefone resolvidos ao mesmo tempo
+    compartilham a mesma consulta/criação; entre buckets em paralelo, o mesmo telefone é tratado por um de cada vez """
+    def lookup():
+        with singleflight.process_lock(phone_number):
+            # Verifica se o contato já existe; se não existir, cria um novo
+            return check_contact_existence(phone_number, token) or create_contact(phone_number, payer_name, BOT_ID, token)
+    
+    return _contact_lookups.do(contact_index.normalize_phone(phone_number), lookup)
+
+
+def resolve_contact(phone_number, payer_name, boleto_url, due_date, token):
+    """ Garante que o contato existe na SendPulse e define as variáveis do boleto. Retorna o contact_id ou None """
+    contact_id = find_or_create_contact(phone_number, payer_name, token)
+    
+    # Se conseguiu obter um contact_id, define as variáveis
+    if contact_id:
+        set_variable(contact_id, VARIABLE_ID_BOLETO, boleto_url, token)
+        set_variable(contact_id, VARIABLE_ID_DUE_DATE, due_date, token)
+    
+    return contact_id
+
+
+def load_parked_boletos(boletos):
+    """ Junta os boletos estacionados em execuções anteriores (circuit breaker aberto) aos boletos do dia.
+    O arquivo só é regravado ou apagado pelo main() depois de salvar os resultados, para não perder os boletos
+    se a execução for interrompida """
+    if not os.path.exists(PARKED_FILE):
+        return boletos
+
+    with open(PARKED_FILE, 'r', encoding='utf-8') as file:
+        parked = parse_payments(json.load(file))
+
+    keys = {boleto.key for boleto in boletos}
+    pending = [boleto for boleto in parked if boleto.key not in keys]
+    logger.info('%s boletos estacionados retomados de %s.', len(pending), PARKED_FILE)
+    return pending + boletos
+
+
+def process_boleto(boleto, token, halted):
+    """ Resolve o contato de um boleto (models.Payment). Retorna um ResolveResult com status, contato e erro.
+    halted: evento compartilhado pela execução, ligado quando a SendPulse fica fora ou recusa o token """
+    payer_name = boleto.payer_name or 'Desconhecido'
+    
+    # Verificação antes de formatar
+    if not boleto.payer_phone:
+        logger.warning('Boleto sem telefone. Nome: %s. Pulando...', payer_name)
+        return ResolveResult(STATUS_IGNORED, boleto, error='sem telefone')
+    
+    # SendPulse já indisponível (ou token recusado) nesta execução: nem tenta
+    if halted.is_set():
+        return ResolveResult(STATUS_PARKED, boleto, error='execução interrompida (SendPulse fora ou token recusado)')
+    
+    # Tempo da execução esgotado: o restante fica para a próxima
+    if budget.expired():
+        return ResolveResult(STATUS_PARKED, boleto, error='tempo da execução esgotado')
+    
+    phone_number = format_phone_number(boleto.payer_phone)
+    
+    # Telefone com falha recente: pula até o fim do TTL do cache negativo
+    cached_failure = negative_cache.get(phone_number)
+    if cached_failure:
+        logger.info('Número %s no cache negativo até %s. Pulando...', phone_number, cached_failure['expires_at'], extra={'sample': 'negative_cache_skip'})
+        return ResolveResult(STATUS_SKIPPED, boleto, error=cached_failure['reason'])
+    
+    try:
+        contact_id = resolve_contact(phone_number, payer_name, boleto.boleto_url, boleto.due_date, token)
+    except CircuitOpenError as e:
+        halted.set()
+        return ResolveResult(STATUS_PARKED, boleto, error=str(e))
+    except TokenRejectedError as e:
+        # Problema do token, não do número: para a execução sem marcar os telefones no cache negativo
+        if not halted.is_set():
+            logger.error('%s. Interrompendo a resolução; os boletos restantes ficam estacionados.', e)
+            metrics.incr('contact_manager.token_rejected')
+        halted.set()
+        return ResolveResult(STATUS_PARKED, boleto, error=str(e))
+    except RetryExhaustedError as e:
+        # Falha transitória persistente: vai para a fila de mensagens mortas (replay_dead_letter.py)
+        dead_letter.add(dead_letter.KIND_CONTACT, boleto.key, boleto.to_dict(), str(e), e.attempts)
+        logger.error('%s Boleto de %s (%s) enviado para %s.', e, payer_name, phone_number, dead_letter.DEAD_LETTER_FILE)
+        return ResolveResult(STATUS_DEAD_LETTERED, boleto, error=str(e))
+    except Exception as e:
+        # Resposta inesperada (ex.: 200 sem JSON, criação sem id): falha só deste boleto, o lote continua
+        logger.exception('Erro inesperado ao resolver o boleto de %s (%s)', payer_name, phone_number)
+        metrics.incr('contact_manager.unexpected_errors')
+        return ResolveResult(STATUS_FAILED, boleto, error=repr(e))
+    
+    if not contact_id:
+        cached_failure = negative_cache.get(phone_number)
+        error = cached_failure['reason'] if cached_failure else 'contato não encontrado nem criado'
+        return ResolveResult(STATUS_FAILED, boleto, error=error)
+    
+    negative_cache.clear(phone_number)
+    logger.info('Boleto processado para %s (%s)', payer_name, phone_number, extra={'sample': 'boleto_processed'})
+    return ResolveResult(STATUS_PROCESSED, boleto, contact=Contact.from_payment(boleto, contact_id, phone_number))
+
+
+def drop_settled(boletos):
+    """ Remove os boletos que a conciliação (reconcile.py) já marcou como pagos após um lembrete """
+    settled = send_history.settled_lines(boleto.digital_line for boleto in boletos)
+    if not settled:
+        return boletos
+    logger.info('%s boletos já quitados após lembrete removidos da lista.', len(settled))
+    metrics.incr('contact_manager.settled', len(settled))
+    return [boleto for boleto in boletos if boleto.digital_line not in settled]
+
+
+def resolve_boletos(boletos, token):
+    """ Resolve os boletos em paralelo (até CONTACT_WORKERS por vez), mantendo a ordem de entrada """
+    halted = threading.Event()
+    # Lista de supressão conferida em lote antes de qualquer chamada à SendPulse (inclusive nos reprocessamentos do dispatch.py)
+    suppressed = suppression.load().suppressed_payments(boletos)
+    if suppressed:
+        logger.info('%s boletos na lista de supressão não serão resolvidos.', len(suppressed))
+        metrics.incr('contact_manager.suppressed', len(suppressed))
+    
+    def resolve(boleto):
+        if boleto.key in suppressed:
+            return ResolveResult(STATUS_SUPPRESSED, boleto, error=suppressed[boleto.key])
+        # Span 'resolve' no trace do boleto, com as chamadas à SendPulse como filhas
+        with tracing.span('resolve', boleto.boleto_key):
+            result = process_boleto(boleto, token, halted)
+            tracing.set_attribute('resolve.status', result.status)
+            return result
     
-    # Salva o arquivo
-    with open(filename, 'w', encoding='utf-8') as file:
-        json.dump(data, file, indent=4, ensure_ascii=False)
+    with ThreadPoolExecutor(max_workers=CONTACT_WORKERS) as executor:
+        return list(executor.map(resolve, boletos))
 
 
 def main():
@@ -119,65 +334,65 @@ def main():
         logger.error('Falha ao obter o token de acesso.')
         return
     
-    json_file = 'dispatcher-charge-five-days/debitos/listDebit.json'
+    json_file = storage.bucket_path('debitos', 'listDebit.json')
     
     if not os.path.exists(json_file):
-        logger.error(f'O arquivo {json_file} não foi encontrado.')
+        logger.error('O arquivo %s não foi encontrado.', json_file)
         return
     
     with open(json_file, 'r', encoding='utf-8') as file:
-        boletos = json.load(file)
-    
-    processed_contacts = []
-    ignored_boletos = []
-    
-    for boleto in boletos:
-        payer_phone = boleto.get('PayerPhone')
-        payer_name = boleto.get('PayerName', 'Desconhecido')
-        boleto_url = boleto.get('BoletoUrl')
-        due_date = boleto.get('DueDate')
-        
-        # Verificação antes de formatar
-        if not payer_phone:
-            logger.warning(f'Boleto sem telefone. Nome: {payer_name}. Pulando...')
-            ignored_boletos.append(boleto)
-            continue
-        
-        phone_number = format_phone_number(payer_phone)
-        
-        # Verifica se o contato já existe
-        contact_id = check_contact_existence(phone_number, token)
-        
-        # Se não existir, cria um novo
-        if not contact_id:
-            contact_id = create_contact(phone_number, payer_name, BOT_ID, token)
-        
-        # Se conseguiu obter um contact_id, define as variáveis
-        if contact_id:
-            set_variable(contact_id, VARIABLE_ID_BOLETO, boleto_url, token)
-            set_variable(contact_id, VARIABLE_ID_DUE_DATE, due_date, token)
-            
-            processed_contacts.append({
-                'contact_id': contact_id,
-                'phone': phone_number,
-                'name': payer_name,
-                'boleto_url': boleto_url,
-                'due_date': due_date
-            })
-            logger.info(f'Boleto processado para {payer_name} ({phone_number})')
-
-    # Salva os contatos processados
-    if processed_contacts:
+        boletos = parse_payments(json.load(file))
+    
+    boletos = drop_settled(load_parked_boletos(boletos))
+    # Os mais importantes primeiro, para o caso de o tempo da execução acabar
+    boletos = priority.rank_payments(boletos)
+    
+    if PREFETCH_CONTACTS:
+        contact_index.warm_up(BOT_ID, token)
+    
+    results = resolve_boletos(boletos, token)
+    
+    processed_contacts = [result.contact.to_dict() for result in results if result.status == STATUS_PROCESSED]
+    ignored_boletos = [result.payment.to_dict() for result in results if result.status == STATUS_IGNORED]
+    parked_boletos = [result.payment.to_dict() for result in results if result.status == STATUS_PARKED]
+    failed_boletos = [result.to_dict() for result in results if result.status in (STATUS_FAILED, STATUS_DEAD_LETTERED)]
+    
+    if parked_boletos:
+        logger.error('SendPulse indisponível, token recusado ou tempo da execução esgotado. Estacionando %s boletos.', len(parked_boletos))
+
+    # Salva os contatos processados (mesmo vazio quando houve estacionamento, para não reenviar a lista anterior)
+    if processed_contacts or parked_boletos:
         save_to_json(processed_contacts, CONTACTS_FILE)
-        logger.info(f'Arquivo {CONTACTS_FILE} atualizado com {len(processed_contacts)} contatos.')
+        logger.info('Arquivo %s atualizado com %s contatos.', CONTACTS_FILE, len(processed_contacts))
 
     # Salva os boletos ignorados
     if ignored_boletos:
         save_to_json(ignored_boletos, IGNORED_FILE)
-        logger.warning(f'Arquivo {IGNORED_FILE} criado com {len(ignored_boletos)} boletos ignorados.')
+        logger.warning('Arquivo %s criado com %s boletos ignorados.', IGNORED_FILE, len(ignored_boletos))
+
+    # Salva o relatório de falhas por boleto
+    if failed_boletos:
+        save_to_json(failed_boletos, FAILED_FILE)
+        logger.warning('Arquivo %s criado com %s boletos com falha.', FAILED_FILE, len(failed_boletos))
+    elif os.path.exists(FAILED_FILE):
+        os.remove(FAILED_FILE)
+
+    # Salva os boletos estacionados
+    if parked_boletos:
+        save_to_json(parked_boletos, PARKED_FILE)
+        logger.warning('Arquivo %s criado com %s boletos estacionados.', PARKED_FILE, len(parked_boletos))
+    elif os.path.exists(PARKED_FILE):
+        # Os estacionados da execução anterior foram todos tratados
+        os.remove(PARKED_FILE)
+
+    negative_cache.save()
+    contact_index.save()
 
+    for result in results:
+        metrics.incr(f'contact_manager.{result.status}')
+    metrics.dump(METRICS_FILE, 'contact_manager')
     logger.info('Processamento concluído.')
 
 
 if __name__ == '__main__':
-    main()
+    profiling.run_stage('contact_manager', main)
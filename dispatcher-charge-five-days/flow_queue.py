@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import storage
+from models import Contact
+
+# Fila persistente (SQLite) dos flows/run a iniciar depois do sendTemplate.
+# Cada item guarda o contato e o id do envio do template (send_history) que o originou.
+QUEUE_FILE = storage.bucket_path('fila', 'flow_queue.db')
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_FAILED = 'failed'
+
+_connection = None
+_lock = threading.Lock()
+
+
+class FlowTask:
+    __slots__ = ('task_id', 'contact', 'send_id', 'attempts', 'status', 'last_error', 'updated_at')
+
+    def __init__(self, task_id, contact, send_id, attempts, status=STATUS_PENDING, last_error=None, updated_at=None):
+        self.task_id = task_id
+        self.contact = contact
+        self.send_id = send_id
+        self.attempts = attempts
+        self.status = status
+        self.last_error = last_error
+        self.updated_at = updated_at
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(QUEUE_FILE), exist_ok=True)
+        _connection = sqlite3.connect(QUEUE_FILE, timeout=30, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        with _connection:
+            _connection.execute("""
+                CREATE TABLE IF NOT EXISTS flow_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL UNIQUE,
+                    payload TEXT NOT NULL,
+                    send_id INTEGER,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at TEXT NOT NULL,
+                    last_error TEXT,
+                    enqueued_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )""")
+            _connection.execute('CREATE INDEX IF NOT EXISTS flow_queue_ready ON flow_queue (status, next_attempt_at)')
+    return _connection
+
+
+def _task(row):
+    task_id, payload, send_id, attempts, status, last_error, updated_at = row
+    return FlowTask(task_id, Contact.from_dict(json.loads(payload)), send_id, attempts, status, last_error, updated_at)
+
+
+def enqueue(contact, send_id=None):
+    """ Agenda o início do fluxo para o contato cujo template acabou de ser enviado """
+    now = _now()
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute(
+                'INSERT INTO flow_queue (key, payload, send_id, status, attempts, next_attempt_at, enqueued_at, updated_at) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, send_id = excluded.send_id, '
+                'status = excluded.status, attempts = 0, next_attempt_at = excluded.next_attempt_at, '
+                'last_error = NULL, updated_at = excluded.updated_at',
+                (contact.key, json.dumps(contact.to_dict(), ensure_ascii=False), send_id, STATUS_PENDING, now, now, now))
+
+
+def claim():
+    """ Pega o próximo item pronto (pendente e com horário de nova tentativa vencido), ou None """
+    now = _now()
+    with _lock:
+        connection = _connect()
+        while True:
+            row = connection.execute(
+                'SELECT id, payload, send_id, attempts, status, last_error, updated_at FROM flow_queue '
+                'WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT 1',
+                (STATUS_PENDING, now)).fetchone()
+            if row is None:
+                return None
+            # Só fica com o item se ele ainda estiver pendente (outro processo pode ter pego entre o SELECT e o UPDATE)
+            with connection:
+                cursor = connection.execute('UPDATE flow_queue SET status = ?, updated_at = ? WHERE id = ? AND status = ?',
+                                            (STATUS_RUNNING, now, row[0], STATUS_PENDING))
+            if cursor.rowcount == 1:
+                return _task(row)
+
+
+def complete(task_id):
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute('DELETE FROM flow_queue WHERE id = ?', (task_id,))
+
+
+def fail(task_id, error, retry_delay, max_attempts):
+    """ Registra a falha: agenda nova tentativa após retry_delay segundos ou, esgotadas as tentativas, marca como falho """
+    now = datetime.now()
+    with _lock:
+        connection = _connect()
+        with connection:
+            attempts = connection.execute('SELECT attempts FROM flow_queue WHERE id = ?', (task_id,)).fetchone()[0] + 1
+            status = STATUS_FAILED if attempts >= max_attempts else STATUS_PENDING
+            next_attempt_at = (now + timedelta(seconds=retry_delay)).isoformat(timespec='seconds')
+            connection.execute(
+                'UPDATE flow_queue SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?',
+                (status, attempts, next_attempt_at, str(error), now.isoformat(timespec='seconds'), task_id))
+    return status
+
+
+def recover(stale_seconds=300):
+    """ Devolve à fila os itens que ficaram 'running' por uma execução interrompida
+    (sem atualização há stale_seconds, para não pegar itens em andamento em outro worker) """
+    limit = (datetime.now() - timedelta(seconds=stale_seconds)).isoformat(timespec='seconds')
+    with _lock:
+        connection = _connect()
+        with connection:
+            return connection.execute('UPDATE flow_queue SET status = ? WHERE status = ? AND updated_at < ?',
+                                      (STATUS_PENDING, STATUS_RUNNING, limit)).rowcount
+
+
+def retry_failed():
+    """ Recoloca os itens falhos na fila, com as tentativas zeradas """
+    now = _now()
+    with _lock:
+        connection = _connect()
+        with connection:
+            return connection.execute(
+                'UPDATE flow_queue SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = ?',
+                (STATUS_PENDING, now, now, STATUS_FAILED)).rowcount
+
+
+def items(status=None):
+    query = 'SELECT id, payload, send_id, attempts, status, last_error, updated_at FROM flow_queue'
+    params = ()
+    if status:
+        query += ' WHERE status = ?'
+        params = (status,)
+    with _lock:
+        rows = _connect().execute(query + ' ORDER BY id', params).fetchall()
+    return [_task(row) for row in rows]
+
+
+def counts():
+    with _lock:
+        return dict(_connect().execute('SELECT status, COUNT(*) FROM flow_queue GROUP BY status').fetchall())
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
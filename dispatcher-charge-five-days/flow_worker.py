@@ -0,0 +1,164 @@
+import os
+import logging
+import argparse
+import threading
+import requests
+from dotenv import load_dotenv
+
+import budget
+import contact_manager
+import flow_queue
+import log_setup
+import metrics
+import profiling
+import run_lock
+import storage
+import tracing
+from retry import UnknownOutcomeError, request_with_retry
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+FLOW_ID = os.getenv('FLOW_ID', '')  # Mantendo como string
+# Workers e novas tentativas dos flows/run (independentes do envio dos templates)
+FLOW_WORKERS = int(os.getenv('FLOW_WORKERS', 4))
+FLOW_MAX_ATTEMPTS = int(os.getenv('FLOW_MAX_ATTEMPTS', 5))
+FLOW_RETRY_DELAY = float(os.getenv('FLOW_RETRY_DELAY', 60))  # segundos; dobra a cada tentativa
+# Itens 'running' sem atualização há mais que isso são de uma execução interrompida (não de outro worker ativo)
+FLOW_STALE_SECONDS = float(os.getenv('FLOW_STALE_SECONDS', 300))
+POLL_INTERVAL = 0.5
+
+METRICS_FILE = storage.bucket_path('metricas', 'flow_worker.json')
+
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+def start_flow(contact, token):
+    """ Inicia o fluxo do WhatsApp para o contato (models.Contact). Propaga requests.exceptions.RequestException """
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    # 🔹 Chamada da API para iniciar o fluxo do WhatsApp
+    flow_url = 'https://api.sendpulse.com/whatsapp/flows/run'
+    flow_payload = {
+        "contact_id": contact.contact_id,
+        "flow_id": FLOW_ID,
+        "external_data": {"tracking_number": contact.boleto_url}
+    }
+    flow_response = request_with_retry('sendpulse.flows_run', 'POST', flow_url, headers=headers, json=flow_payload)
+    flow_response.raise_for_status()
+
+
+def process_task(task, token):
+    """ Executa um item da fila de fluxos. Retorna True se o fluxo foi iniciado """
+    contact = task.contact
+    try:
+        with tracing.span('flow', contact.boleto_key, **{'flow.attempt': task.attempts + 1}):
+            start_flow(contact, token)
+    except UnknownOutcomeError as e:
+        # O fluxo pode ter sido iniciado: não repete sozinho, fica como falho para conferência (--retry-failed)
+        flow_queue.fail(task.task_id, e, 0, 0)
+        logger.error('Resultado desconhecido ao iniciar fluxo para %s (%s): %s. Não repetido; confira antes de usar '
+                     'flow_worker.py --retry-failed', contact.name, contact.phone, e)
+        metrics.incr('flow_worker.unknown_outcome')
+        return False
+    except requests.exceptions.RequestException as e:
+        retry_delay = FLOW_RETRY_DELAY * 2 ** task.attempts
+        status = flow_queue.fail(task.task_id, e, retry_delay, FLOW_MAX_ATTEMPTS)
+        if status == flow_queue.STATUS_FAILED:
+            logger.error('Erro ao iniciar fluxo para %s (%s): %s. Tentativas esgotadas; use flow_worker.py --retry-failed',
+                         contact.name, contact.phone, e)
+            metrics.incr('flow_worker.failed')
+        else:
+            logger.warning('Erro ao iniciar fluxo para %s (%s): %s. Nova tentativa em %.0fs',
+                           contact.name, contact.phone, e, retry_delay)
+            metrics.incr('flow_worker.retry_scheduled')
+        return False
+
+    flow_queue.complete(task.task_id)
+    logger.info('Fluxo iniciado para %s (%s)', contact.name, contact.phone, extra={'sample': 'flow_started'})
+    metrics.incr('flow_worker.started')
+    return True
+
+
+class FlowWorkers:
+    """ Threads que esvaziam a fila de fluxos em paralelo ao envio dos templates """
+
+    def __init__(self, get_token, workers=None):
+        self.get_token = get_token
+        self.workers = workers or FLOW_WORKERS
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        recovered = flow_queue.recover(FLOW_STALE_SECONDS)
+        if recovered:
+            logger.info('%s fluxos interrompidos na execução anterior voltaram para a fila', recovered)
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'flow-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def _run(self):
+        while not budget.expired():
+            task = flow_queue.claim()
+            if task is None:
+                # Sem item pronto: termina se o envio acabou, senão espera novos templates enviados
+                if self._stopping.is_set():
+                    return
+                self._stopping.wait(POLL_INTERVAL)
+                continue
+            process_task(task, self.get_token())
+
+    def stop(self):
+        """ Espera os workers esvaziarem os itens prontos. Itens agendados para nova tentativa ficam para a próxima execução """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def drain(get_token, workers=None):
+    """ Inicia os fluxos prontos da fila e retorna quando não houver mais nenhum """
+    FlowWorkers(get_token, workers).start().stop()
+
+
+def main():
+    """ Inicia os fluxos pendentes da fila (ou reenvia os falhos) sem enviar templates """
+    parser = argparse.ArgumentParser(description='Inicia os fluxos pendentes da fila de fluxos')
+    parser.add_argument('--retry-failed', action='store_true', help='recoloca na fila os fluxos com tentativas esgotadas')
+    parser.add_argument('--list', choices=[flow_queue.STATUS_PENDING, flow_queue.STATUS_RUNNING, flow_queue.STATUS_FAILED],
+                        help='lista os itens da fila com este status e sai')
+    args = parser.parse_args()
+
+    if args.list:
+        for task in flow_queue.items(args.list):
+            print(f"{task.task_id}\t{task.contact.name}\t{task.contact.phone}\tenvio {task.send_id}\t"
+                  f"tentativas {task.attempts}\t{task.updated_at}\t{task.last_error or ''}")
+        return
+
+    if args.retry_failed:
+        logger.info('%s fluxos falhos recolocados na fila', flow_queue.retry_failed())
+
+    client_id = os.getenv('SENDPULSE_CLIENT_ID')
+    client_secret = os.getenv('SENDPULSE_CLIENT_SECRET')
+    if not client_id or not client_secret:
+        logger.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
+        return
+
+    token = contact_manager.get_access_token(client_id, client_secret)
+    if not token:
+        return
+
+    drain(lambda: token)
+    logger.info('Fila de fluxos: %s', flow_queue.counts() or 'vazia')
+    metrics.dump(METRICS_FILE, 'flow_worker')
+
+
+if __name__ == "__main__":
+    # Não roda junto com o automaticRun do bucket (mesma fila)
+    try:
+        with run_lock.hold():
+            profiling.run_stage('flow_worker', main)
+    except storage.BucketLockedError as e:
+        logger.error("%s. Fluxos não iniciados.", e)
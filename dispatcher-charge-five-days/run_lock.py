@@ -0,0 +1,142 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+import contextlib
+
+import storage
+
+# Lock de execução com lease: só um runner ativo por tenant e bucket, mesmo com o job agendado em mais de uma máquina.
+# O dono renova o lease (heartbeat) enquanto roda; se ele morrer ou travar, o lease vence e outra instância assume.
+#   RUN_LOCK_FILE                banco dos leases (padrão historico/run_locks.db; num disco compartilhado entre as máquinas)
+#   TENANT_ID                    tenant (clínica) do lock (padrão 'default')
+#   RUN_LOCK_TTL_SECONDS         validade do lease sem heartbeat (padrão 90; maior que a diferença de relógio entre as máquinas)
+#   RUN_LOCK_WAIT                1 para aguardar o lock em vez de sair (padrão 0)
+#   RUN_LOCK_WAIT_TIMEOUT        máximo de espera em segundos (padrão 3600)
+LOCK_FILE = os.getenv('RUN_LOCK_FILE') or storage.root_path('historico', 'run_locks.db')
+DEFAULT_TTL_SECONDS = 90
+DEFAULT_WAIT_TIMEOUT = 3600
+POLL_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+def _connect():
+    os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+    connection = sqlite3.connect(LOCK_FILE, timeout=30, check_same_thread=False)
+    with connection:
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+    return connection
+
+
+def lock_name(bucket=None):
+    """ Escopo do lock: tenant + bucket """
+    return f"{os.getenv('TENANT_ID', 'default')}:{bucket or os.path.basename(storage.BASE_DIR)}"
+
+
+class RunLease:
+    """ Lease de execução com heartbeat em segundo plano. lost indica que outra instância assumiu o lock """
+
+    def __init__(self, name, ttl=None):
+        self.name = name
+        self.ttl = ttl or float(os.getenv('RUN_LOCK_TTL_SECONDS', DEFAULT_TTL_SECONDS))
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lost = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._connection = _connect()
+        self._lock = threading.Lock()
+
+    def holder(self):
+        """ (dono, segundos até vencer) do lease atual, ou None """
+        with self._lock:
+            row = self._connection.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (self.name,)).fetchone()
+        return (row[0], row[1] - time.time()) if row else None
+
+    def try_acquire(self):
+        """ Pega o lease se estiver livre ou vencido (takeover). Um único upsert condicional: atômico entre processos """
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                previous = self._connection.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (self.name,)).fetchone()
+                cursor = self._connection.execute(
+                    'INSERT INTO leases (name, owner, acquired_at, expires_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, acquired_at = excluded.acquired_at, '
+                    'expires_at = excluded.expires_at WHERE leases.expires_at < ? OR leases.owner = excluded.owner',
+                    (self.name, self.owner, now, now + self.ttl, now))
+        if cursor.rowcount != 1:
+            return False
+        if previous and previous[0] != self.owner:
+            logger.warning('Lease de %s vencido (%s parou de renovar). Assumindo a execução.', self.name, previous[0])
+        self._thread = threading.Thread(target=self._heartbeat, name='run-lock-heartbeat', daemon=True)
+        self._thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.ttl / 3):
+            try:
+                with self._lock:
+                    with self._connection:
+                        renewed = self._connection.execute(
+                            'UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?',
+                            (time.time() + self.ttl, self.name, self.owner)).rowcount
+            except sqlite3.Error as e:
+                # Banco ocupado ou disco compartilhado indisponível: tenta de novo no próximo heartbeat
+                logger.warning('Falha ao renovar o lease de %s: %s', self.name, e)
+                continue
+            if not renewed:
+                logger.error('Lease de %s perdido para outra instância. Interrompendo esta execução.', self.name)
+                self.lost.set()
+                return
+
+    def release(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            with self._connection:
+                self._connection.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (self.name, self.owner))
+            self._connection.close()
+
+
+@contextlib.contextmanager
+def hold(wait=None, bucket=None):
+    """ Lock local do bucket (storage.bucket_lock) + lease de execução do tenant/bucket. Retorna o RunLease.
+    Se outra instância estiver ativa, levanta storage.BucketLockedError ou, com wait (RUN_LOCK_WAIT=1), aguarda """
+    if wait is None:
+        wait = os.getenv('RUN_LOCK_WAIT', '0') == '1'
+    give_up_at = time.monotonic() + float(os.getenv('RUN_LOCK_WAIT_TIMEOUT', DEFAULT_WAIT_TIMEOUT))
+    name = lock_name(bucket)
+
+    while True:
+        stack = contextlib.ExitStack()
+        try:
+            stack.enter_context(storage.bucket_lock())
+            lease = RunLease(name)
+            if not lease.try_acquire():
+                owner, seconds_left = lease.holder() or ('?', 0)
+                lease.release()
+                raise storage.BucketLockedError(f'{name} já está em execução em {owner} (lease vence em {seconds_left:.0f}s)')
+        except storage.BucketLockedError as e:
+            stack.close()
+            if not wait or time.monotonic() >= give_up_at:
+                raise
+            logger.info('%s. Aguardando...', e)
+            time.sleep(POLL_INTERVAL)
+            continue
+        break
+
+    with stack:
+        try:
+            yield lease
+        finally:
+            lease.release()
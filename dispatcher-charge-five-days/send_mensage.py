@@ -1,17 +1,57 @@
 import os
+import sys
 import json
+import time
+import socket
 import logging
+import subprocess
 import requests
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import budget
+import dead_letter
+import eligibility
+import events
+import find_charge
+import flow_queue
+import flow_worker
+import log_setup
+import retry
+import metrics
+import priority
+import profiling
+import scheduler
+import send_history
+import send_queue
+import storage
+import suppression
+import tracing
+from http_client import CircuitOpenError
+from models import SendResult, parse_contacts, parse_due_date
+from retry import RetryExhaustedError, UnknownOutcomeError, request_with_retry
 
 # Carrega as variáveis de ambiente
 load_dotenv()
 
-FLOW_ID = os.getenv('FLOW_ID', '')  # Mantendo como string
+# Confere o status atual dos boletos na Clinicorp (uma única consulta) antes de enviar
+RECHECK_STATUS_BEFORE_SEND = os.getenv('RECHECK_STATUS_BEFORE_SEND', '0') == '1'
+# O token da SendPulse vale 1 hora; com a fila espalhada pela janela de envio ele é renovado antes disso
+TOKEN_MAX_AGE_SECONDS = int(os.getenv('SENDPULSE_TOKEN_MAX_AGE', 3000))
+# Processos que esvaziam a fila de envio em paralelo (send_worker.py), cada um com uma parte dos shards
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 1))
+
+# Folga do lease de envio além do pior caso das tentativas (espera pelo limite de concorrência da SendPulse)
+SEND_LEASE_MARGIN_SECONDS = float(os.getenv('SEND_LEASE_MARGIN_SECONDS', 60))
+# Validade de um contato na fila desde a última importação (a busca de cada dia renova a data dos que continuam devidos):
+# o que ficou retido (janela fechada, circuit breaker aberto) e não foi confirmado pela busca seguinte sai sem envio
+SEND_QUEUE_TTL_HOURS = float(os.getenv('SEND_QUEUE_TTL_HOURS', 20))
+
+METRICS_FILE = storage.bucket_path('metricas', 'send_mensage.json')
 
 # Configuração de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log_setup.configure()
+logger = logging.getLogger(__name__)
 
 def get_auth_token(client_id, client_secret):
     """ Obtém o token de autenticação na API SendPulse """
@@ -22,11 +62,11 @@ def get_auth_token(client_id, client_secret):
         'client_secret': client_secret
     }
     try:
-        response = requests.post(auth_url, data=auth_data)
+        response = request_with_retry('sendpulse.oauth', 'POST', auth_url, data=auth_data)
         response.raise_for_status()
         return response.json().get('access_token')
     except requests.exceptions.RequestException as e:
-        logging.error(f'Erro ao obter token de autorização: {e}')
+        logger.error('Erro ao obter token de autorização: %s', e)
         return None
 
 def format_due_date(due_date):
@@ -36,8 +76,11 @@ def format_due_date(due_date):
     except ValueError:
         return 'Data inválida'
 
-def send_whatsapp_message(contact_id, phone, name, boleto_url, due_date, token):
-    """ Envia uma mensagem WhatsApp utilizando o template correto """
+def send_whatsapp_message(contact, token):
+    """ Envia uma mensagem WhatsApp (models.Contact) utilizando o template correto e agenda o início do fluxo
+    na fila de fluxos (flow_worker). Retorna um models.SendResult (sent=False se a SendPulse recusou o envio).
+    Propaga CircuitOpenError e RetryExhaustedError quando o template não pôde ser enviado por indisponibilidade da SendPulse. """
+    contact_id, phone, name, due_date = contact.contact_id, contact.phone, contact.name, contact.due_date
     try:
         send_message_url = 'https://api.sendpulse.com/whatsapp/contacts/sendTemplate'
         formatted_date = format_due_date(due_date)
@@ -90,61 +133,251 @@ def send_whatsapp_message(contact_id, phone, name, boleto_url, due_date, token):
         
         headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
 
-        response = requests.post(send_message_url, headers=headers, json=send_message_payload)
+        response = request_with_retry('sendpulse.send_template', 'POST', send_message_url, headers=headers, json=send_message_payload)
         response.raise_for_status()
-        logging.info(f'Mensagem enviada para {name} ({phone})')
+        logger.info('Mensagem enviada para %s (%s)', name, phone, extra={'sample': 'message_sent'})
+        metrics.incr('send_mensage.sent')
+        send_id = send_history.record(contact, send_history.STATUS_SENT)
+    except (CircuitOpenError, RetryExhaustedError):
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.error('Erro ao enviar mensagem para %s (%s): %s', name, phone, e)
+        metrics.incr('send_mensage.failed')
+        send_history.record(contact, send_history.STATUS_FAILED)
+        return SendResult(contact, False, error=str(e))
 
-        # 🔹 Chamada da API para iniciar o fluxo do WhatsApp
-        flow_url = 'https://api.sendpulse.com/whatsapp/flows/run'
-        flow_payload = {
-            "contact_id": contact_id,
-            "flow_id": FLOW_ID,
-            "external_data": {"tracking_number": boleto_url}
-        }
-        flow_response = requests.post(flow_url, headers=headers, json=flow_payload)
-        flow_response.raise_for_status()
-        logging.info(f'Fluxo iniciado para {name} ({phone})')
+    # O fluxo é iniciado pelos workers da fila de fluxos, sem segurar o próximo template
+    flow_queue.enqueue(contact, send_id)
+    return SendResult(contact, True, send_id)
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f'Erro ao enviar mensagem ou iniciar fluxo para {name} ({phone}): {e}')
+def import_contacts(contacts_file):
+    """ Coloca na fila de envio os contatos gerados pelo contact_manager (uma única vez por versão do arquivo) """
+    contacts_data = []
+    if os.path.exists(contacts_file):
+        version = str(os.stat(contacts_file).st_mtime_ns)
+        if send_queue.get_meta('contacts_file_version') != version:
+            try:
+                with open(contacts_file, 'r', encoding='utf-8') as file:
+                    contacts_data = parse_contacts(json.load(file))
+            except json.JSONDecodeError:
+                logger.error('Erro ao ler o JSON de %s', contacts_file)
+                return
+            send_queue.set_meta('contacts_file_version', version)
+    else:
+        logger.error('Arquivo %s não encontrado', contacts_file)
+
+    added = send_queue.enqueue(contacts_data)
+    logger.info('%s contatos novos na fila de envio (%s no total)', added, send_queue.size())
+
+def recheck_eligibility(contacts_data):
+    """ Remove contatos cujo boleto deixou de ser elegível (ex.: foi pago) desde a busca """
+    # Sem cache: o objetivo é ver o status atual
+    payments = find_charge.get_monthly_payments(use_cache=False)
+    if not payments:
+        logger.warning('Não foi possível reconsultar os boletos na Clinicorp. Enviando sem reconferência')
+        return contacts_data
+
+    # Reaplica as regras em lote só aos boletos que estão na lista de envio
+    lines = {contact.digital_line for contact in contacts_data} - {None}
+    matched = [payment for payment in payments if payment.digital_line in lines]
+    _, rejected = eligibility.filter_eligible(matched)
+    reasons = {item['payment'].digital_line: item['reason'] for item in rejected}
+
+    eligible = []
+    for contact in contacts_data:
+        reason = reasons.get(contact.digital_line)
+        if reason:
+            logger.info('Boleto de %s não é mais elegível (%s). Pulando...', contact.name, reason)
+            metrics.incr('send_mensage.no_longer_eligible')
+            continue
+        eligible.append(contact)
+    return eligible
+
+def skip_known_useless(contacts_data):
+    """ Tira da fila os contatos que, pelos eventos do webhook, já responderam ou não estão recebendo mensagens """
+    reasons = events.skip_reasons(contacts_data)
+    remaining = []
+    for contact in contacts_data:
+        reason = reasons.get(contact.key)
+        if reason:
+            logger.info('Contato %s (%s) pulado: %s', contact.name, contact.phone, reason, extra={'sample': 'event_skip'})
+            metrics.incr('send_mensage.skipped_by_events')
+            send_queue.remove(contact.key)
+            continue
+        remaining.append(contact)
+    return remaining
+
+def prepare_queue():
+    """ Importa o arquivo de contatos para a fila de envio e, com RECHECK_STATUS_BEFORE_SEND, tira dela os boletos
+    que deixaram de ser elegíveis (os demais descartes são feitos em drain_queue, em drop_unsendable) """
+    import_contacts(storage.bucket_path('contatos', 'contacts.json'))
+    contacts_data = send_queue.pending()
+    
+    if RECHECK_STATUS_BEFORE_SEND and contacts_data:
+        eligible = recheck_eligibility(contacts_data)
+        eligible_keys = {contact.key for contact in eligible}
+        for contact in contacts_data:
+            if contact.key not in eligible_keys:
+                send_queue.remove(contact.key)
+
+def drop_settled(contacts_data):
+    """ Tira da fila os boletos pagos após um lembrete (reconcile.py) """
+    settled = send_history.settled_lines(contact.digital_line for contact in contacts_data)
+    for contact in contacts_data:
+        if contact.digital_line in settled:
+            send_queue.remove(contact.key)
+    return [contact for contact in contacts_data if contact.digital_line not in settled]
+
+def drop_suppressed(contacts_data):
+    """ Tira da fila os contatos que entraram na lista de supressão depois da busca (consulta em lote, antes dos envios) """
+    suppressed = suppression.load().suppressed_contacts(contacts_data)
+    for contact in contacts_data:
+        reason = suppressed.get(contact.key)
+        if reason:
+            logger.info('Contato %s (%s) na lista de supressão (%s). Pulando...', contact.name, contact.phone, reason)
+            send_queue.remove(contact.key)
+    if suppressed:
+        metrics.incr('send_mensage.suppressed', len(suppressed))
+    return [contact for contact in contacts_data if contact.key not in suppressed]
+
+def drop_unsendable(contacts_data):
+    """ Tira da fila, antes dos envios, os contatos quitados, suprimidos ou que pelos eventos não devem receber mensagem.
+    Vale para todo envio pela fila, inclusive os reprocessamentos (dispatch.py send, replay_dead_letter.py) """
+    return skip_known_useless(drop_suppressed(drop_settled(contacts_data)))
+
+def expired_reason(contact, enqueued_at, now=None):
+    """ Motivo para tirar da fila sem envio um contato retido: vencimento fora da faixa deste bucket (o template fala em
+    "N dias") ou mais de SEND_QUEUE_TTL_HOURS na fila sem a busca confirmá-lo. None se o contato ainda vale """
+    now = now or datetime.now()
+    due_on = parse_due_date(contact.due_date)
+    if due_on is not None and not find_charge.in_bucket_window((now.date() - due_on).days):
+        return f'vencimento em {due_on.isoformat()} fora da faixa do bucket'
+    if enqueued_at is not None and now - enqueued_at > timedelta(hours=SEND_QUEUE_TTL_HOURS):
+        return f'na fila desde {enqueued_at.isoformat(timespec="minutes")}'
+    return None
+
+def send_lease_seconds():
+    """ Lease de um contato reservado: precisa durar mais que o envio mais lento possível, senão outro worker
+    reserva o mesmo contato no meio do envio e manda o template de novo (SEND_LEASE_SECONDS fixa o valor) """
+    configured = os.getenv('SEND_LEASE_SECONDS')
+    if configured:
+        return float(configured)
+    return retry.worst_case_seconds('sendpulse.send_template') + SEND_LEASE_MARGIN_SECONDS
+
+def drain_queue(client_id, client_secret, shards=None, workers=1, keys=None):
+    """ Envia os contatos da fila (opcionalmente só dos shards ou das chaves informados) dentro da janela e da cota configuradas.
+    Com vários workers, a cota por minuto é dividida entre eles e cada contato é reservado (lease) antes do envio.
+    Retorna quantos contatos foram processados """
+    token = get_auth_token(client_id, client_secret)
+    if not token:
+        return 0
+    auth = {'token': token, 'issued_at': time.monotonic()}
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    lease_seconds = send_lease_seconds()
+    
+    contacts_data = priority.rank_contacts(send_queue.pending(shards))
+    if keys is not None:
+        contacts_data = [contact for contact in contacts_data if contact.key in keys]
+    contacts_data = drop_unsendable(contacts_data)
+    schedule = scheduler.SendSchedule.from_env()
+    schedule.rate_per_minute /= max(1, workers)
+    
+    def finish(contact, owned):
+        # remove/fail só valem se o lease ainda é deste worker; se venceu, outro worker pode ter enviado o mesmo contato
+        if not owned:
+            logger.warning('Lease do contato %s (%s) vencido durante o envio: outro worker assumiu o contato.',
+                           contact.name, contact.phone)
+            metrics.incr('send_mensage.lease_lost')
+        return True
+    
+    def deliver(contact):
+        # O token é renovado antes da reserva, para o lease cobrir só o envio
+        if time.monotonic() - auth['issued_at'] > TOKEN_MAX_AGE_SECONDS:
+            auth['token'] = get_auth_token(client_id, client_secret) or auth['token']
+            auth['issued_at'] = time.monotonic()
+        
+        if not send_queue.claim(contact.key, owner, lease_seconds):
+            # Reservado por outro worker ou já enviado
+            metrics.incr('send_mensage.claim_skipped')
+            return None
+        
+        # Conferido na reserva: a fila atravessa dias e o contato pode ter saído da faixa do bucket enquanto esperava
+        reason = expired_reason(contact, send_queue.enqueued_at(contact.key))
+        if reason:
+            logger.info('Contato %s (%s) tirado da fila sem envio: %s', contact.name, contact.phone, reason)
+            metrics.incr('send_mensage.expired')
+            send_queue.remove(contact.key, owner)
+            return None
+        
+        if not contact.is_valid:
+            logger.warning('Contato inválido encontrado. Pulando...')
+            return finish(contact, send_queue.remove(contact.key, owner))
+        
+        try:
+            with tracing.span('send', contact.boleto_key):
+                result = send_whatsapp_message(contact, auth['token'])
+            if not result.sent:
+                # Recusado pela SendPulse: sai da fila, mas fica guardado para reenvio (dispatch.py send --status failed)
+                return finish(contact, send_queue.fail(contact.key, result.error or 'envio recusado pela SendPulse', owner))
+        except CircuitOpenError as e:
+            # SendPulse indisponível: o restante continua na fila para a próxima execução
+            send_queue.release(contact.key, owner)
+            logger.error('%s Mantendo %s contatos na fila de envio.', e, send_queue.size())
+            return False
+        except RetryExhaustedError as e:
+            # Falha transitória persistente: vai para a fila de mensagens mortas (replay_dead_letter.py)
+            # Com resultado desconhecido o template pode ter sido entregue: fica marcado e não é reenviado automaticamente
+            dead_letter.add(dead_letter.KIND_SEND, contact.key, contact.to_dict(), str(e), e.attempts,
+                            unknown_outcome=isinstance(e, UnknownOutcomeError))
+            metrics.incr('send_mensage.dead_lettered')
+            logger.error('%s. Contato %s (%s) enviado para %s', e, contact.name, contact.phone, dead_letter.DEAD_LETTER_FILE)
+        return finish(contact, send_queue.remove(contact.key, owner))
+    
+    flow_workers = flow_worker.FlowWorkers(lambda: auth['token']).start()
+    try:
+        return scheduler.run(contacts_data, deliver, schedule=schedule, deadline=budget.deadline())
+    finally:
+        flow_workers.stop()
+
+def run_workers(workers):
+    """ Esvazia a fila com SEND_WORKERS processos (send_worker.py), cada um com uma parte dos shards """
+    worker_script = storage.bucket_path('send_worker.py')
+    processes = []
+    for index in range(workers):
+        shards = [shard for shard in range(send_queue.SEND_SHARDS) if shard % workers == index]
+        if not shards:
+            continue
+        command = [sys.executable, worker_script, '--shards', ','.join(map(str, shards)), '--workers', str(workers)]
+        processes.append(subprocess.Popen(command))
+    failed = sum(1 for process in processes if process.wait() != 0)
+    if failed:
+        logger.error('%s de %s workers de envio terminaram com erro.', failed, len(processes))
+    metrics.incr('send_mensage.worker_failures', failed)
 
 def main():
-    """ Executa o envio de mensagens para todos os contatos no arquivo JSON """
+    """ Coloca os contatos do arquivo JSON na fila de envio e a esvazia dentro da janela e da cota configuradas """
     client_id = os.getenv('SENDPULSE_CLIENT_ID')
     client_secret = os.getenv('SENDPULSE_CLIENT_SECRET')
     
     if not client_id or not client_secret:
-        logging.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
+        logger.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
         return
     
-    token = get_auth_token(client_id, client_secret)
-    if not token:
-        return
+    prepare_queue()
     
-    contacts_file = 'dispatcher-charge-five-days/contatos/contacts.json'
+    if SEND_WORKERS > 1:
+        run_workers(SEND_WORKERS)
+        logger.info('Envio feito por %s workers (métricas em metricas/send_worker-*.json).', SEND_WORKERS)
+    else:
+        delivered = drain_queue(client_id, client_secret)
+        logger.info('%s contatos processados.', delivered)
+    remaining = send_queue.size()
+    metrics.set_gauge('send_mensage.queue_remaining', remaining)
+    logger.info('%s contatos continuam na fila de envio.', remaining)
+    logger.info('Fila de fluxos: %s', flow_queue.counts() or 'vazia')
+    send_queue.close()
 
-    try:
-        with open(contacts_file, 'r', encoding='utf-8') as file:
-            contacts_data = json.load(file)
-    except FileNotFoundError:
-        logging.error(f'Arquivo {contacts_file} não encontrado')
-        return
-    except json.JSONDecodeError:
-        logging.error(f'Erro ao ler o JSON de {contacts_file}')
-        return
-    
-    for contact_info in contacts_data:
-        contact_id = contact_info.get('contact_id')
-        phone = contact_info.get('phone')
-        name = contact_info.get('name', 'Cliente')
-        boleto_url = contact_info.get('boleto_url', 'Sem link')
-        due_date = contact_info.get('due_date', 'Sem data')
-
-        if not contact_id or not phone:
-            logging.warning(f'Contato inválido encontrado. Pulando...')
-            continue
-        
-        send_whatsapp_message(contact_id, phone, name, boleto_url, due_date, token)
+    metrics.dump(METRICS_FILE, 'send_mensage')
 
 if __name__ == "__main__":
-    main()
+    profiling.run_stage('send_mensage', main)
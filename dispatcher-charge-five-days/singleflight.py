@@ -0,0 +1,79 @@
+import os
+import zlib
+import fcntl
+import threading
+import contextlib
+
+import metrics
+import storage
+import tracing
+
+# Coalescência de chamadas duplicadas: threads que pedem a mesma chave ao mesmo tempo compartilham uma única
+# execução e o seu resultado. Entre processos (buckets rodando em paralelo) a mesma chave é serializada por um
+# lock de arquivo, para que o segundo processo encontre o que o primeiro criou em vez de criar de novo.
+#   SINGLEFLIGHT_CROSS_PROCESS   1 para o lock entre processos (padrão 1)
+LOCK_DIR = storage.root_path('cache', 'locks')
+# Os locks entre processos são distribuídos em faixas pelo hash da chave, para não criar um arquivo por telefone
+LOCK_STRIPES = 256
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    """ Execuções em andamento por chave """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """ Executa func() uma vez para as chamadas simultâneas com a mesma chave. Quem chega durante a execução
+        espera e recebe o mesmo resultado (ou a mesma exceção) """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.incr(f'singleflight.{self.name}.shared')
+            tracing.set_attribute('singleflight.shared', True)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+@contextlib.contextmanager
+def process_lock(key):
+    """ Lock exclusivo da chave entre processos (liberado pelo sistema operacional se o processo morrer) """
+    if os.getenv('SINGLEFLIGHT_CROSS_PROCESS', '1') != '1':
+        yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    stripe = zlib.crc32(str(key).encode('utf-8')) % LOCK_STRIPES
+    with open(os.path.join(LOCK_DIR, f'{stripe:03d}.lock'), 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
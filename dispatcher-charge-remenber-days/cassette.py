@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+import requests
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Gravação e reprodução das chamadas HTTP (Clinicorp e SendPulse) para testes de desempenho offline.
+#   HTTP_CASSETTE_MODE=record   grava todas as trocas em HTTP_CASSETTE_FILE (uma por linha, sem segredos)
+#   HTTP_CASSETTE_MODE=replay   responde a partir do arquivo, sem acessar a rede
+#   HTTP_REPLAY_LATENCY_SCALE   multiplica a latência original na reprodução (0 = sem espera)
+# Na reprodução use CLINICORP_CACHE_TTL=0 para que o cache de respostas não esconda as chamadas gravadas.
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+DEFAULT_CASSETTE_FILE = storage.root_path('cassettes', 'cassette.jsonl')
+
+SECRET_FIELDS = {'authorization', 'client_id', 'client_secret', 'access_token', 'refresh_token'}
+RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+REDACTED = 'REDACTED'
+
+_lock = threading.Lock()
+_interactions = None
+
+
+def get_mode():
+    return os.getenv('HTTP_CASSETTE_MODE', '').lower()
+
+
+def is_recording():
+    return get_mode() == MODE_RECORD
+
+
+def is_replaying():
+    return get_mode() == MODE_REPLAY
+
+
+def cassette_file():
+    return os.getenv('HTTP_CASSETTE_FILE', DEFAULT_CASSETTE_FILE)
+
+
+def scrub(value):
+    """ Substitui recursivamente os campos sensíveis """
+    if isinstance(value, dict):
+        return {key: REDACTED if key.lower() in SECRET_FIELDS else scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def _request_body(kwargs):
+    body = kwargs.get('json', kwargs.get('data'))
+    if isinstance(body, (str, bytes)):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+    return scrub(body)
+
+
+def _match_key(endpoint, method, url, kwargs):
+    params = scrub(dict(kwargs.get('params') or {}))
+    return json.dumps([endpoint, method.upper(), url, params, _request_body(kwargs)], sort_keys=True, default=str)
+
+
+def record(endpoint, method, url, kwargs, elapsed, response=None, error=None):
+    """ Acrescenta uma troca ao arquivo de gravação """
+    entry = {
+        'endpoint': endpoint,
+        'method': method.upper(),
+        'url': url,
+        'params': scrub(dict(kwargs.get('params') or {})),
+        'body': _request_body(kwargs),
+        'elapsed': round(elapsed, 4)
+    }
+    if error is not None:
+        entry['error'] = {'type': type(error).__name__, 'message': str(error)}
+    else:
+        try:
+            response_body = json.dumps(scrub(response.json()), ensure_ascii=False)
+        except ValueError:
+            response_body = response.text
+        entry['response'] = {
+            'status_code': response.status_code,
+            'headers': {name: response.headers[name] for name in RESPONSE_HEADERS if name in response.headers},
+            'body': response_body
+        }
+
+    path = cassette_file()
+    with _lock:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def _load():
+    global _interactions
+    if _interactions is None:
+        by_key = defaultdict(deque)
+        by_endpoint = defaultdict(deque)
+        with open(cassette_file(), 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                kwargs = {'params': entry['params'], 'json': entry['body']}
+                entry['key'] = _match_key(entry['endpoint'], entry['method'], entry['url'], kwargs)
+                entry['used'] = False
+                by_key[entry['key']].append(entry)
+                by_endpoint[entry['endpoint']].append(entry)
+        _interactions = (by_key, by_endpoint)
+        logger.info("Reproduzindo chamadas HTTP de %s", cassette_file())
+    return _interactions
+
+
+def _next_entry(endpoint, method, url, kwargs):
+    """ Próxima troca gravada com a mesma requisição; se não houver (ex.: datas diferentes),
+    a próxima ainda não usada do mesmo endpoint, na ordem da gravação """
+    by_key, by_endpoint = _load()
+    candidates = by_key.get(_match_key(endpoint, method, url, kwargs))
+    while candidates:
+        entry = candidates.popleft()
+        if not entry['used']:
+            entry['used'] = True
+            return entry
+    candidates = by_endpoint.get(endpoint)
+    while candidates:
+        entry = candidates.popleft()
+        if not entry['used']:
+            entry['used'] = True
+            return entry
+    return None
+
+
+def replay(endpoint, method, url, kwargs):
+    """ Devolve a resposta gravada (ou relança o erro gravado), respeitando a latência original escalada """
+    with _lock:
+        entry = _next_entry(endpoint, method, url, kwargs)
+    if entry is None:
+        raise requests.exceptions.ConnectionError(f'Sem gravação para {endpoint} em {cassette_file()}')
+
+    time.sleep(entry['elapsed'] * float(os.getenv('HTTP_REPLAY_LATENCY_SCALE', 1)))
+
+    if 'error' in entry:
+        error_class = getattr(requests.exceptions, entry['error']['type'], requests.exceptions.ConnectionError)
+        raise error_class(entry['error']['message'])
+
+    response = requests.models.Response()
+    response.status_code = entry['response']['status_code']
+    response._content = entry['response']['body'].encode('utf-8')
+    response.headers = requests.structures.CaseInsensitiveDict(entry['response']['headers'])
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
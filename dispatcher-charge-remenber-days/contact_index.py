@@ -0,0 +1,108 @@
+import os
+import json
+import logging
+import threading
+import requests
+from datetime import datetime, timedelta
+
+import metrics
+import storage
+from retry import request_with_retry
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.sendpulse.com/whatsapp/contacts'
+PHONE_INDEX_FILE = storage.bucket_path('contatos', 'phone_index.json')
+
+# Tamanho da página e idade máxima do índice salvo (CONTACT_INDEX_PAGE_SIZE e CONTACT_INDEX_MAX_AGE_HOURS no .env)
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_AGE_HOURS = 24
+
+_index = None
+_lock = threading.Lock()
+
+
+def normalize_phone(phone_number):
+    return ''.join(filter(str.isdigit, str(phone_number or '')))
+
+
+def _contact_phone(contact):
+    channel_data = contact.get('channel_data') or {}
+    return normalize_phone(channel_data.get('phone') or contact.get('phone'))
+
+
+def _load_file(bot_id):
+    if not os.path.exists(PHONE_INDEX_FILE):
+        return None
+    with open(PHONE_INDEX_FILE, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    return data if data.get('bot_id') == bot_id else None
+
+
+def fetch_all_contacts(bot_id, token):
+    """ Percorre todas as páginas de contatos do bot e retorna {telefone: contact_id} """
+    page_size = int(os.getenv('CONTACT_INDEX_PAGE_SIZE', DEFAULT_PAGE_SIZE))
+    headers = {'Accept': 'application/json', 'Authorization': f'Bearer {token}'}
+    contacts = {}
+    skip = 0
+
+    while True:
+        params = {'bot_id': bot_id, 'limit': page_size, 'skip': skip}
+        response = request_with_retry('sendpulse.list_contacts', 'GET', API_URL, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json().get('data') or []
+        metrics.incr('contact_index.pages')
+
+        for contact in page:
+            phone_number = _contact_phone(contact)
+            if phone_number and contact.get('id'):
+                contacts[phone_number] = contact['id']
+
+        if len(page) < page_size:
+            return contacts
+        skip += page_size
+
+
+def warm_up(bot_id, token):
+    """ Carrega o índice de telefones do bot, baixando a lista completa se o arquivo salvo estiver velho """
+    global _index
+    max_age = timedelta(hours=float(os.getenv('CONTACT_INDEX_MAX_AGE_HOURS', DEFAULT_MAX_AGE_HOURS)))
+    data = _load_file(bot_id)
+
+    if data is None or datetime.now() - datetime.fromisoformat(data['built_at']) > max_age:
+        try:
+            contacts = fetch_all_contacts(bot_id, token)
+            data = {'bot_id': bot_id, 'built_at': datetime.now().isoformat(timespec='seconds'), 'contacts': contacts}
+            logger.info("Índice de contatos do bot atualizado: %d telefones.", len(contacts))
+        except requests.exceptions.RequestException as e:
+            logger.error("Erro ao baixar contatos do bot: %s. Usando o índice salvo, se houver.", e)
+
+    with _lock:
+        _index = data
+    if data is not None:
+        metrics.set_gauge('contact_index.size', len(data['contacts']))
+        save()
+
+
+def lookup(phone_number):
+    """ Retorna o contact_id do telefone se o índice estiver carregado e o contiver """
+    with _lock:
+        if _index is None:
+            return None
+        contact_id = _index['contacts'].get(normalize_phone(phone_number))
+    metrics.incr('contact_index.hits' if contact_id else 'contact_index.misses')
+    return contact_id
+
+
+def add(phone_number, contact_id):
+    """ Inclui no índice um contato encontrado ou criado pela API """
+    with _lock:
+        if _index is not None:
+            _index['contacts'][normalize_phone(phone_number)] = contact_id
+
+
+def save():
+    with _lock:
+        if _index is None:
+            return
+        storage.write_json(PHONE_INDEX_FILE, _index)
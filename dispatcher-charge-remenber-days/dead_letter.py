@@ -0,0 +1,77 @@
+import os
+import json
+import uuid
+import fcntl
+import threading
+import contextlib
+from datetime import datetime
+
+import storage
+
+DEAD_LETTER_FILE = storage.bucket_path('dlq', 'dead_letter.json')
+# Os workers de envio (send_worker.py) são processos separados: cada alteração do arquivo é feita sob este lock
+LOCK_FILE = storage.bucket_path('dlq', 'dead_letter.lock')
+
+# Tipos de item na fila
+KIND_CONTACT = 'contact'  # criação de contato / definição de variáveis (payload: boleto)
+KIND_SEND = 'send'        # envio do template (payload: contato)
+
+_lock = threading.Lock()
+
+
+def load():
+    """ Retorna os itens da fila de mensagens mortas """
+    if not os.path.exists(DEAD_LETTER_FILE):
+        return []
+    with open(DEAD_LETTER_FILE, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _save(entries):
+    storage.write_json(DEAD_LETTER_FILE, entries)
+
+
+@contextlib.contextmanager
+def _locked():
+    """ Lock exclusivo entre threads e entre processos (liberado pelo sistema operacional se o processo morrer) """
+    with _lock:
+        os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+        with open(LOCK_FILE, 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def add(kind, key, payload, error, attempts, unknown_outcome=False):
+    """ Adiciona (ou atualiza, se já existir o mesmo tipo e chave) um item que esgotou as tentativas.
+    unknown_outcome: a última chamada pode ter sido executada pela SendPulse (retry.UnknownOutcomeError) """
+    with _locked():
+        entries = load()
+        now = datetime.now().isoformat(timespec='seconds')
+        for entry in entries:
+            if entry['kind'] == kind and entry['key'] == key:
+                entry.update(payload=payload, error=error, unknown_outcome=unknown_outcome, updated_at=now)
+                entry['attempts'] += attempts
+                break
+        else:
+            entries.append({
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'key': key,
+                'payload': payload,
+                'error': error,
+                'attempts': attempts,
+                'unknown_outcome': unknown_outcome,
+                'created_at': now,
+                'updated_at': now
+            })
+        _save(entries)
+
+
+def remove(entry_id):
+    """ Remove um item (reenvio bem-sucedido ou descarte) """
+    with _locked():
+        entries = [entry for entry in load() if entry['id'] != entry_id]
+        _save(entries)
@@ -1,105 +1,159 @@
 import requests
-import json
 import logging
 import os
-from datetime import date, datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from dotenv import load_dotenv
+
+# Carrega as variáveis de ambiente antes dos módulos que as leem na importação (cache, trace, regras de elegibilidade),
+# também quando o script roda sozinho (python find_charge.py), fora do automaticRun
+load_dotenv()
+
+import eligibility
+import log_setup
+import metrics
+import models
+import priority
+import profiling
+import response_cache
+import storage
+import tracing
 
 # Configuração do logger
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log_setup.configure()
 logger = logging.getLogger(__name__)
 
 # Constantes
 API_URL = 'https://api.clinicorp.com/rest/v1/payment/list'
 ACCEPT_HEADER = 'application/json'
 AUTH_HEADER = 'Basic c29ycmlzb3NvZG9udG9sb2dpYToxZjNkMTA2MC0yNTJlLTQ4OTUtYjU2ZS1mNGYyYzliZDAwZDI='
-OUTPUT_DIR = 'dispatcher-charge-remenber-days/debitos'
+OUTPUT_DIR = storage.bucket_path('debitos')
 OUTPUT_FILE = 'listDebit.json'
+METRICS_FILE = storage.bucket_path('metricas', 'find_charge.json')
+SUBSCRIBER_ID = 'sorrisosodontologia'
 
-# Função para calcular os dias vencidos
-def calculate_due_days(due_date):
-    try:
-        today = date.today()
-        due_date_obj = datetime.strptime(due_date, '%Y-%m-%dT%H:%M:%S.%fZ').date()
-        return (today - due_date_obj).days
-    except ValueError as e:
-        logger.error("Erro ao converter data: %s", e)
-        return None
-
-# Função para formatar número de telefone
-def format_phone_number(phone):
-    if phone:
-        phone = ''.join(filter(str.isdigit, phone))
-        if not phone.startswith('55'):
-            phone = '55' + phone
-        if len(phone) == 13 and phone.startswith('55'):
-            phone = phone[:4] + phone[5:]  # Remove o primeiro zero após o DDD
-        if len(phone) != 12:
-            phone = phone.rjust(12, '0')
-    return phone
-
-# Função para obter pagamentos (ampliando o intervalo)
-def get_monthly_payments():
+# Janela de busca e divisão em sub-intervalos buscados em paralelo
+FETCH_WINDOW_DAYS = 60
+FETCH_SHARD_DAYS = int(os.getenv('FETCH_SHARD_DAYS', 10))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 4))
+
+# Função para dividir o intervalo de datas em sub-intervalos de até shard_days dias
+def split_date_range(from_date, to_date, shard_days):
+    shards = []
+    start = from_date
+    while start <= to_date:
+        end = min(start + timedelta(days=shard_days - 1), to_date)
+        shards.append((start, end))
+        start = end + timedelta(days=1)
+    return shards
+
+# Função para identificar um pagamento (para remover duplicados entre sub-intervalos)
+def payment_id(payment):
+    return payment.get('id') or payment.get('PaymentId') or (
+        payment.get('BoletoDigitalLine'), payment.get('DueDate'), payment.get('PayerName'))
+
+# Função para obter os pagamentos de um sub-intervalo (via cache em disco, a menos que use_cache=False)
+def fetch_payments_range(from_date, to_date, use_cache=True):
+    params = {
+        'subscriber_id': SUBSCRIBER_ID,
+        'from': from_date.strftime('%Y-%m-%d'),
+        'to': to_date.strftime('%Y-%m-%d'),
+        'search_type': 'DUE_DATE'
+    }
+    headers = {'accept': ACCEPT_HEADER, 'Authorization': AUTH_HEADER}
+    return response_cache.cached_get_json('clinicorp.payment_list', API_URL, params, headers, use_cache) or []
+
+# Função para obter pagamentos (ampliando o intervalo), buscando os sub-intervalos em paralelo.
+# Retorna models.Payment já validados. from_date/to_date substituem a janela padrão (ex.: reprocessamento pontual)
+def get_monthly_payments(use_cache=True, from_date=None, to_date=None):
+    today = date.today()
+    from_date = from_date or today - timedelta(days=FETCH_WINDOW_DAYS)  # Últimos 60 dias
+    to_date = to_date or today
+    shards = split_date_range(from_date, to_date, FETCH_SHARD_DAYS)
+
+    logger.info("Enviando %d requisições para: %s", len(shards), API_URL)
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        futures = {executor.submit(fetch_payments_range, start, end, use_cache): (start, end) for start, end in shards}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except requests.exceptions.RequestException as e:
+                logger.warning("Falha no intervalo %s a %s: %s", futures[future][0], futures[future][1], e)
+                failed.append(futures[future])
+
+    # Nova tentativa isolada para cada sub-intervalo que falhou
+    for start, end in failed:
+        try:
+            results[(start, end)] = fetch_payments_range(start, end, use_cache)
+            metrics.incr('find_charge.shard_recovered')
+        except requests.exceptions.RequestException as e:
+            logger.error("Erro na requisição do intervalo %s a %s: %s", start, end, e)
+            metrics.incr('find_charge.shard_failed')
+
+    # Junta os resultados na ordem das datas, sem duplicados
+    data = []
+    seen = set()
+    for shard in sorted(results):
+        for payment in results[shard]:
+            key = payment_id(payment)
+            if key not in seen:
+                seen.add(key)
+                data.append(payment)
+
+    logger.info("API retornou %d registros (%d de %d intervalos)", len(data), len(results), len(shards))
+    return models.parse_payments(data)
+
+# Faixa de dias desde o vencimento atendida por este bucket (também conferida no envio, send_mensage)
+def in_bucket_window(due_days):
+    return due_days is not None and 0 <= due_days <= 2
+
+# Função para selecionar os pagamentos deste bucket, na ordem de prioridade
+def select_payments(monthly_payments, today):
+    started = time.time()
+    # Descarta em lote pagamentos quitados/cancelados, suprimidos ou de valor baixo
+    eligible_payments, _ = eligibility.filter_eligible(monthly_payments)
+
+    filtered_payments = []
+    for payment in eligible_payments:
+        due_days = payment.days_due(today)
+        if in_bucket_window(due_days):  # Aceita boletos vencidos há pelo menos 30 dias
+            filtered_payments.append(payment)
+
+    # Ordem de prioridade (atraso, valor, lembretes já enviados) em vez de só pela data de vencimento
+    ranked_payments = priority.rank_payments(filtered_payments, today)
+
+    # Classificação em lote: o span de cada boleto selecionado cobre o lote inteiro
+    finished = time.time()
+    for rank, payment in enumerate(ranked_payments):
+        tracing.record('classify', payment.boleto_key, started, finished,
+                       **{'due_days': payment.days_due(today), 'priority.rank': rank, 'batch_size': len(monthly_payments)})
+    return ranked_payments
+
+# Função para salvar a lista de boletos usada pelo contact_manager
+def save_payments(payments, today, output_file=OUTPUT_FILE):
+    sorted_payments = [payment.to_dict(today) for payment in payments]
     try:
-        today = date.today()
-        from_date = today - timedelta(days=60)  # Últimos 60 dias
-        to_date = today
-
-        params = {
-            'subscriber_id': 'sorrisosodontologia',
-            'from': from_date.strftime('%Y-%m-%d'),
-            'to': to_date.strftime('%Y-%m-%d'),
-            'search_type': 'DUE_DATE'
-        }
-
-        logger.info("Enviando requisição para: %s", API_URL)
-        response = requests.get(API_URL, params=params, headers={'accept': ACCEPT_HEADER, 'Authorization': AUTH_HEADER})
-        response.raise_for_status()
-        
-        data = response.json()
-        logger.info("API retornou %d registros", len(data))
-        return data if data else []
-    except requests.exceptions.RequestException as e:
-        logger.error("Erro na requisição: %s", e)
-        return []
+        storage.write_json(os.path.join(OUTPUT_DIR, output_file), sorted_payments)
+        logger.info("Arquivo '%s' criado com sucesso. Total de registros: %d", output_file, len(sorted_payments))
+    except Exception as e:
+        logger.error("Erro ao salvar os dados: %s", e)
 
 # Função para filtrar e salvar pagamentos (permitindo boletos vencidos há 30 dias ou mais)
 def filter_and_save_payments():
     monthly_payments = get_monthly_payments()
     if monthly_payments:
-        filtered_payments = []
-        for payment in monthly_payments:
-            due_date = payment.get('DueDate')
-            if due_date:
-                due_days = calculate_due_days(due_date)
-                if 0 <= due_days <= 2:  # Aceita boletos vencidos há pelo menos 30 dias
-                    payment['PayerPhone'] = format_phone_number(payment.get('PayerPhone'))
-                    filtered_payments.append({
-                        'PayerName': payment.get('PayerName'),
-                        'ExternalStatus': payment.get('ExternalStatus'),
-                        'BoletoUrl': payment.get('BoletoUrl'),
-                        'PayerPhone': payment['PayerPhone'],
-                        'DueDate': payment.get('DueDate'),
-                        'DaysDue': due_days,
-                        'BoletoDigitalLine': payment.get('BoletoDigitalLine')
-                    })
-
-        sorted_payments = sorted(filtered_payments, key=lambda x: x['DueDate'])
-
-        if not os.path.exists(OUTPUT_DIR):
-            os.makedirs(OUTPUT_DIR)
-
-        try:
-            with open(os.path.join(OUTPUT_DIR, OUTPUT_FILE), 'w') as file:
-                json.dump(sorted_payments, file, indent=4, ensure_ascii=False)
-                logger.info("Arquivo '%s' criado com sucesso. Total de registros: %d", OUTPUT_FILE, len(sorted_payments))
-        except Exception as e:
-            logger.error("Erro ao salvar os dados: %s", e)
+        today = date.today()
+        save_payments(select_payments(monthly_payments, today), today)
     else:
         logger.warning("Nenhum pagamento encontrado.")
 
 # Função principal
 def main():
     filter_and_save_payments()
+    metrics.dump(METRICS_FILE, 'find_charge')
 
 if __name__ == "__main__":
-    main()
+    profiling.run_stage('find_charge', main)
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+import metrics
+import storage
+
+# Os registros vão para uma fila em memória; formatação e escrita ficam com a thread do QueueListener.
+#   LOG_LEVEL         nível mínimo (padrão INFO)
+#   LOG_JSON          1 para gravar também em JSON por linha em logs/dispatcher.jsonl (padrão 1)
+#   LOG_SAMPLE_RATE   registra 1 a cada N linhas de sucesso repetitivas (extra={'sample': chave}); 1 = todas
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_DIR = storage.bucket_path('logs')
+LOG_FILE = 'dispatcher.jsonl'
+DEFAULT_SAMPLE_RATE = 10
+
+_listener = None
+_sampling = None
+_started = time.monotonic()
+_configure_lock = threading.Lock()
+
+# Atributos padrão do LogRecord (o resto veio em extra= e vai para o JSON)
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """ Deixa passar 1 a cada N registros marcados com extra={'sample': chave}; os demais só são contados """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.seen = {}
+        self.suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or self.rate == 1:
+            return True
+        with self._lock:
+            count = self.seen[key] = self.seen.get(key, 0) + 1
+            if (count - 1) % self.rate == 0:
+                return True
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+
+
+class LazyQueueHandler(QueueHandler):
+    """ Enfileira o registro sem formatar a mensagem na thread que registrou """
+
+    def prepare(self, record):
+        return record
+
+
+def configure():
+    """ Configura o logging assíncrono do processo (chamadas repetidas são ignoradas) """
+    global _listener, _sampling
+    with _configure_lock:
+        if _listener is not None:
+            return
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = [stream_handler]
+
+        if os.getenv('LOG_JSON', '1') == '1':
+            os.makedirs(LOG_DIR, exist_ok=True)
+            json_handler = logging.FileHandler(os.path.join(LOG_DIR, LOG_FILE), encoding='utf-8')
+            json_handler.setFormatter(JsonFormatter())
+            handlers.append(json_handler)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = LazyQueueHandler(log_queue)
+        _sampling = SamplingFilter(int(os.getenv('LOG_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)))
+        queue_handler.addFilter(_sampling)
+
+        root = logging.getLogger()
+        root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        root.addHandler(queue_handler)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def log_summary(stage):
+    """ Um registro por execução com a duração, os contadores e quantas linhas foram omitidas pela amostragem """
+    summary = {
+        'stage': stage,
+        'duration_seconds': round(time.monotonic() - _started, 3),
+        'counters': metrics.snapshot()['counters'],
+        'sampled_out': dict(_sampling.suppressed) if _sampling else {}
+    }
+    logging.getLogger(stage).info('Resumo da execução de %s: %s', stage, summary['counters'], extra={'summary': summary})
+
+
+def shutdown():
+    """ Esvazia a fila e encerra a thread de escrita """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,204 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Registros compartilhados pelas etapas (find_charge -> contact_manager -> send_mensage).
+# Cada registro é validado uma única vez na entrada e usa __slots__ para ocupar pouca memória;
+# to_dict/from_dict mantêm o formato dos arquivos JSON (listDebit.json, contacts.json).
+
+DUE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def format_phone_number(phone):
+    """ Normaliza o telefone da Clinicorp para 55 + DDD + número (12 dígitos) """
+    if phone:
+        phone = ''.join(filter(str.isdigit, phone))
+        if not phone.startswith('55'):
+            phone = '55' + phone
+        if len(phone) == 13 and phone.startswith('55'):
+            phone = phone[:4] + phone[5:]  # Remove o primeiro zero após o DDD
+        if len(phone) != 12:
+            phone = phone.rjust(12, '0')
+    return phone
+
+
+def parse_due_date(value):
+    """ Converte a DueDate da Clinicorp em date (None se inválida) """
+    try:
+        return datetime.strptime(value, DUE_DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_amount(raw):
+    """ Valor do pagamento, aceitando os nomes de campo usados pela Clinicorp """
+    for field in ('Amount', 'Value', 'TotalAmount'):
+        if raw.get(field) is not None:
+            try:
+                return float(raw[field])
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class Payment:
+    """ Boleto da Clinicorp """
+    __slots__ = ('payment_id', 'payer_name', 'external_status', 'boleto_url', 'payer_phone',
+                 'payer_document', 'due_date', 'due_on', 'digital_line', 'amount')
+
+    def __init__(self, payment_id, payer_name, external_status, boleto_url, payer_phone,
+                 payer_document, due_date, due_on, digital_line, amount):
+        self.payment_id = payment_id
+        self.payer_name = payer_name
+        self.external_status = external_status
+        self.boleto_url = boleto_url
+        self.payer_phone = payer_phone
+        self.payer_document = payer_document
+        self.due_date = due_date
+        self.due_on = due_on
+        self.digital_line = digital_line
+        self.amount = amount
+
+    @classmethod
+    def from_dict(cls, raw):
+        """ Cria a partir da resposta da Clinicorp ou de um item de listDebit.json """
+        due_date = raw.get('DueDate')
+        return cls(
+            payment_id=raw.get('id') or raw.get('PaymentId'),
+            payer_name=raw.get('PayerName'),
+            external_status=raw.get('ExternalStatus'),
+            boleto_url=raw.get('BoletoUrl'),
+            payer_phone=format_phone_number(raw.get('PayerPhone')),
+            payer_document=raw.get('PayerDocument'),
+            due_date=due_date,
+            due_on=parse_due_date(due_date),
+            digital_line=raw.get('BoletoDigitalLine'),
+            amount=parse_amount(raw)
+        )
+
+    @property
+    def key(self):
+        """ Identificador do boleto (para juntar listas e remover duplicados) """
+        return self.digital_line or self.boleto_url or self.payer_phone
+
+    @property
+    def boleto_key(self):
+        """ Identificador do boleto no histórico de envios """
+        return self.digital_line or self.boleto_url
+
+    def days_due(self, today):
+        return (today - self.due_on).days if self.due_on else None
+
+    def to_dict(self, today=None):
+        data = {
+            'PayerName': self.payer_name,
+            'ExternalStatus': self.external_status,
+            'BoletoUrl': self.boleto_url,
+            'PayerPhone': self.payer_phone,
+            'DueDate': self.due_date,
+            'DaysDue': self.days_due(today) if today else None,
+            'BoletoDigitalLine': self.digital_line,
+            'Amount': self.amount
+        }
+        if self.payment_id:
+            data['id'] = self.payment_id
+        if self.payer_document:
+            data['PayerDocument'] = self.payer_document
+        return data
+
+
+class Contact:
+    """ Contato da SendPulse pronto para receber a mensagem de um boleto """
+    __slots__ = ('contact_id', 'phone', 'name', 'boleto_url', 'due_date', 'digital_line', 'amount')
+
+    def __init__(self, contact_id, phone, name, boleto_url, due_date, digital_line=None, amount=None):
+        self.contact_id = contact_id
+        self.phone = phone
+        self.name = name
+        self.boleto_url = boleto_url
+        self.due_date = due_date
+        self.digital_line = digital_line
+        self.amount = amount
+
+    @classmethod
+    def from_payment(cls, payment, contact_id, phone):
+        return cls(contact_id, phone, payment.payer_name or 'Desconhecido', payment.boleto_url,
+                   payment.due_date, payment.digital_line, payment.amount)
+
+    @classmethod
+    def from_dict(cls, raw):
+        """ Cria a partir de um item de contacts.json """
+        return cls(
+            contact_id=raw.get('contact_id'),
+            phone=raw.get('phone'),
+            name=raw.get('name', 'Cliente'),
+            boleto_url=raw.get('boleto_url', 'Sem link'),
+            due_date=raw.get('due_date', 'Sem data'),
+            digital_line=raw.get('boleto_digital_line'),
+            amount=raw.get('amount')
+        )
+
+    @property
+    def key(self):
+        return f'{self.contact_id}|{self.boleto_url}'
+
+    @property
+    def boleto_key(self):
+        return self.digital_line or self.boleto_url
+
+    @property
+    def is_valid(self):
+        return bool(self.contact_id and self.phone)
+
+    def to_dict(self):
+        return {
+            'contact_id': self.contact_id,
+            'phone': self.phone,
+            'name': self.name,
+            'boleto_url': self.boleto_url,
+            'due_date': self.due_date,
+            'boleto_digital_line': self.digital_line,
+            'amount': self.amount
+        }
+
+
+class ResolveResult:
+    """ Resultado da resolução do contato de um boleto em contact_manager """
+    __slots__ = ('status', 'payment', 'contact', 'error')
+
+    def __init__(self, status, payment, contact=None, error=None):
+        self.status = status
+        self.payment = payment
+        self.contact = contact
+        self.error = error
+
+    def to_dict(self):
+        return {'status': self.status, 'boleto': self.payment.to_dict(), 'error': self.error}
+
+
+class SendResult:
+    """ Resultado do envio do template de um contato em send_mensage """
+    __slots__ = ('contact', 'sent', 'send_id', 'error')
+
+    def __init__(self, contact, sent, send_id=None, error=None):
+        self.contact = contact
+        self.sent = sent
+        self.send_id = send_id
+        self.error = error
+
+
+def parse_payments(raw_payments):
+    """ Validação única na entrada: retorna os pagamentos válidos e descarta os sem data de vencimento válida """
+    payments = []
+    for raw in raw_payments:
+        payment = Payment.from_dict(raw)
+        if payment.due_on is None:
+            logger.error("Pagamento com DueDate inválida descartado: %s (%s)", raw.get('DueDate'), raw.get('PayerName'))
+            continue
+        payments.append(payment)
+    return payments
+
+
+def parse_contacts(raw_contacts):
+    return [Contact.from_dict(raw) for raw in raw_contacts]
@@ -0,0 +1,33 @@
+import argparse
+from datetime import datetime, timedelta
+
+import events
+
+
+def main():
+    """ Consulta os eventos recebidos da SendPulse por webhook """
+    parser = argparse.ArgumentParser(description='Consulta os eventos de entrega e resposta da SendPulse')
+    parser.add_argument('--contact-id', help='filtra pelo contact_id da SendPulse')
+    parser.add_argument('--phone', help='filtra pelo telefone (55 + DDD + número)')
+    parser.add_argument('--kind', choices=events.KINDS, help='filtra pelo tipo de evento')
+    parser.add_argument('--days', type=float, help='somente eventos recebidos nos últimos N dias')
+    parser.add_argument('--limit', type=int, default=50, help='máximo de eventos listados (padrão 50)')
+    parser.add_argument('--summary', action='store_true', help='mostra só a quantidade por tipo')
+    args = parser.parse_args()
+
+    since = datetime.now() - timedelta(days=args.days) if args.days else None
+
+    if args.summary:
+        for kind, count in sorted(events.summary(since).items()):
+            print(f"{kind}\t{count}")
+        return
+
+    rows = events.query(args.contact_id, args.phone, args.kind, since, args.limit)
+    for event_id, contact_id, phone, kind, title, status, event_at, received_at in rows:
+        print(f"{received_at}\t{kind}\t{contact_id or '-'}\t{phone or '-'}\t{title or '-'}\t{status or '-'}\t{event_at or '-'}")
+    if not rows:
+        print("Nenhum evento encontrado.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import logging
+import argparse
+from dotenv import load_dotenv
+
+import contact_index
+import contact_manager
+import dead_letter
+import flow_worker
+import log_setup
+import negative_cache
+import run_lock
+import send_mensage
+import send_queue
+import storage
+from models import Contact, Payment
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+def resolve_entries(entries, token):
+    """ Resolve os contatos dos boletos (itens KIND_CONTACT) pelo mesmo caminho da execução normal, que confere a lista
+    de supressão. Retorna os contatos resolvidos; tira da fila de mensagens mortas os resolvidos e os suprimidos """
+    if not entries:
+        return []
+    ids = {entry['key']: entry['id'] for entry in entries}
+    results = contact_manager.resolve_boletos([Payment.from_dict(entry['payload']) for entry in entries], token)
+    contacts = []
+    for result in results:
+        if result.status == contact_manager.STATUS_PROCESSED:
+            contacts.append(result.contact)
+        elif result.status != contact_manager.STATUS_SUPPRESSED:
+            logger.error("Boleto de %s (%s) não pôde ser resolvido e continua na fila: %s",
+                         result.payment.payer_name, result.payment.payer_phone, result.error)
+            continue
+        dead_letter.remove(ids[result.payment.key])
+    negative_cache.save()
+    contact_index.save()
+    return contacts
+
+
+def main():
+    """ Reenvia somente os itens da fila de mensagens mortas """
+    parser = argparse.ArgumentParser(description='Reenvia os itens da fila de mensagens mortas')
+    parser.add_argument('--kind', choices=[dead_letter.KIND_CONTACT, dead_letter.KIND_SEND],
+                        help='reenvia apenas itens deste tipo')
+    parser.add_argument('--include-unknown', action='store_true',
+                        help='reenvia também os itens com resultado desconhecido (podem já ter sido entregues)')
+    args = parser.parse_args()
+
+    entries = [entry for entry in dead_letter.load() if not args.kind or entry['kind'] == args.kind]
+    unknown = [entry for entry in entries if entry.get('unknown_outcome')]
+    if unknown and not args.include_unknown:
+        logger.warning("%d itens com resultado desconhecido (a SendPulse pode tê-los executado) não serão reenviados. "
+                       "Confira e use --include-unknown.", len(unknown))
+        entries = [entry for entry in entries if not entry.get('unknown_outcome')]
+    if not entries:
+        logger.info("Nenhum item na fila de mensagens mortas.")
+        return
+
+    client_id = os.getenv('SENDPULSE_CLIENT_ID')
+    client_secret = os.getenv('SENDPULSE_CLIENT_SECRET')
+    if not client_id or not client_secret:
+        logger.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
+        return
+
+    token = send_mensage.get_auth_token(client_id, client_secret)
+    if not token:
+        return
+
+    by_kind = {}
+    for entry in entries:
+        by_kind.setdefault(entry['kind'], []).append(entry)
+    for kind in by_kind.keys() - {dead_letter.KIND_CONTACT, dead_letter.KIND_SEND}:
+        logger.error("Tipo de item desconhecido na fila: %s (%d itens)", kind, len(by_kind[kind]))
+
+    # Os envios passam pela fila de envio, como na execução normal (send_mensage.drain_queue): lista de supressão,
+    # boletos quitados, eventos do webhook, janela de envio, cota e lease. O item sai da fila de mensagens mortas ao
+    # entrar na fila de envio; se falhar de novo, drain_queue o devolve para cá
+    contacts = resolve_entries(by_kind.get(dead_letter.KIND_CONTACT, []), token)
+    send_entries = by_kind.get(dead_letter.KIND_SEND, [])
+    contacts += [Contact.from_dict(entry['payload']) for entry in send_entries]
+    send_queue.enqueue(contacts)
+    for entry in send_entries:
+        dead_letter.remove(entry['id'])
+
+    delivered = send_mensage.drain_queue(client_id, client_secret, keys={contact.key for contact in contacts}) if contacts else 0
+    # Inicia os fluxos dos templates reenviados
+    flow_worker.drain(lambda: token)
+    logger.info("Reenvio concluído: %d de %d contatos processados; %d continuam na fila de envio.",
+                delivered, len(contacts), send_queue.size())
+    send_queue.close()
+
+
+if __name__ == "__main__":
+    # Não reenvia enquanto o automaticRun do bucket estiver rodando (mesma fila e mesmos contatos)
+    try:
+        with run_lock.hold():
+            main()
+    except storage.BucketLockedError as e:
+        logger.error("%s. Reenvio não realizado.", e)
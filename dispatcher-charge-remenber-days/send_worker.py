@@ -0,0 +1,60 @@
+import os
+import logging
+import argparse
+from dotenv import load_dotenv
+
+import log_setup
+import metrics
+import profiling
+import send_mensage
+import send_queue
+import storage
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+# Worker de envio: esvazia só os shards informados da fila de envio. Iniciado pelo send_mensage com SEND_WORKERS > 1,
+# ou à mão na mesma máquina (a fila é local, ver send_queue.py). Não usa o lock do bucket: cada contato
+# é reservado por um lease na própria fila, então vários workers podem rodar ao mesmo tempo.
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+def parse_shards(text):
+    """ '0,2,5' ou '0-3' -> lista de shards """
+    shards = []
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-')
+            shards.extend(range(int(start), int(end) + 1))
+        elif part:
+            shards.append(int(part))
+    return shards
+
+
+def main():
+    """ Envia os contatos da fila que pertencem aos shards deste worker """
+    parser = argparse.ArgumentParser(description='Esvazia parte da fila de envio (shards)')
+    parser.add_argument('--shards', default=f'0-{send_queue.SEND_SHARDS - 1}',
+                        help=f'shards deste worker, ex.: 0,2,4 ou 0-3 (padrão: todos os {send_queue.SEND_SHARDS})')
+    parser.add_argument('--workers', type=int, default=1, help='total de workers, para dividir a cota por minuto (padrão 1)')
+    args = parser.parse_args()
+
+    client_id = os.getenv('SENDPULSE_CLIENT_ID')
+    client_secret = os.getenv('SENDPULSE_CLIENT_SECRET')
+    if not client_id or not client_secret:
+        logger.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
+        raise SystemExit(1)
+
+    shards = parse_shards(args.shards)
+    delivered = send_mensage.drain_queue(client_id, client_secret, shards, args.workers)
+    logger.info('Worker dos shards %s: %s contatos processados.', args.shards, delivered)
+    send_queue.close()
+
+    name = 'send_worker-' + '_'.join(map(str, shards))
+    metrics.dump(storage.bucket_path('metricas', f'{name}.json'), name)
+
+
+if __name__ == "__main__":
+    profiling.run_stage('send_worker', main)
@@ -0,0 +1,302 @@
+import os
+import json
+import mmap
+import array
+import glob
+import time
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+
+import metrics
+import singleflight
+import storage
+from models import format_phone_number
+
+logger = logging.getLogger(__name__)
+
+# Lista de supressão (opt-out, bloqueio judicial, débito contestado...): telefones e documentos que não devem receber
+# mensagens. Cada arquivo de origem é compilado em um índice binário (cache/suppression-<assinatura>.idx, compartilhado
+# pelos buckets) que é aberto com mmap: a consulta custa poucos acessos à memória, mesmo com milhões de entradas, e os
+# processos que abrem o mesmo índice dividem as páginas com o sistema operacional em vez de carregar cada um a sua cópia.
+# O índice de um arquivo só é refeito quando ele muda (a lista do bucket não recompila a lista grande compartilhada).
+#
+# Cada entrada diz se é telefone ou documento (um CPF de 11 dígitos tem o tamanho de um celular, então uma entrada
+# sem tipo bloquearia pessoas que não estão na lista); entradas sem tipo são ignoradas com aviso.
+# Arquivos de origem:
+#   debitos/suppression_list.json    lista do bucket: [{"phone": "11999990000", "reason": "opt-out"}, {"document": "123.456.789-09"}]
+#   SUPPRESSION_FILES                outros arquivos, separados por vírgula (caminho relativo à raiz do repositório).
+#                                    .json no mesmo formato ou texto com uma entrada por linha: phone:valor[,motivo] ou
+#                                    doc:valor[,motivo] (# comenta)
+SUPPRESSION_FILE = storage.bucket_path('debitos', 'suppression_list.json')
+INDEX_DIR = storage.root_path('cache')
+DEFAULT_REASON = 'lista de supressão'
+
+# Índices de outras versões das listas são apagados depois deste tempo sem uso
+STALE_INDEX_SECONDS = 7 * 24 * 3600
+
+# Formato do índice: cabeçalho, tabela de hash com endereçamento aberto (chaves de 64 bits, 0 = vazio) e o código
+# do motivo de cada posição. A chave guarda o valor inteiro (tipo + dígitos), então a confirmação é exata
+MAGIC = b'SUPIDX2\0'
+HEADER = struct.Struct('<8sQQI')
+KIND_PHONE = 1
+KIND_DOCUMENT = 2
+MAX_DIGITS = 18
+_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+
+def only_digits(value):
+    return ''.join(filter(str.isdigit, str(value or '')))
+
+
+def _key(kind, digits):
+    """ Chave de 64 bits: o tipo na frente preserva os zeros à esquerda e separa telefones de documentos """
+    if not digits or len(digits) > MAX_DIGITS:
+        return None
+    return int(f'{kind}{digits}')
+
+
+# Tipos aceitos nas entradas (campo do JSON ou prefixo da linha no texto)
+KINDS = {'phone': KIND_PHONE, 'document': KIND_DOCUMENT, 'doc': KIND_DOCUMENT}
+
+
+def phone_key(phone):
+    """ Telefone normalizado (com DDI 55 e sem o nono dígito, como em models.format_phone_number) """
+    digits = only_digits(phone)
+    return _key(KIND_PHONE, format_phone_number(digits)) if digits else None
+
+
+def document_key(document):
+    return _key(KIND_DOCUMENT, only_digits(document))
+
+
+def entry_key(kind, value):
+    """ Chave de uma entrada da lista, só no tipo declarado (None se inválida) """
+    return phone_key(value) if kind == KIND_PHONE else document_key(value)
+
+
+def _slot(key, bits):
+    return ((key * _MULTIPLIER) & _MASK) >> (64 - bits)
+
+
+def source_files():
+    files = [SUPPRESSION_FILE]
+    for path in os.getenv('SUPPRESSION_FILES', '').split(','):
+        if path.strip():
+            files.append(os.path.join(storage.ROOT_DIR, path.strip()))
+    return [path for path in files if os.path.exists(path)]
+
+
+def read_entries(path):
+    """ Gera (tipo, valor, motivo) de um arquivo de origem; tipo None quando a entrada não declara o tipo """
+    if path.endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as file:
+            for entry in json.load(file):
+                if not isinstance(entry, dict):
+                    yield None, entry, None
+                    continue
+                kinds = [name for name in ('phone', 'document') if entry.get(name)]
+                if len(kinds) != 1:
+                    yield None, entry, None
+                    continue
+                yield KINDS[kinds[0]], entry[kinds[0]], entry.get('reason') or DEFAULT_REASON
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                entry, _, reason = line.partition(',')
+                kind, separator, value = entry.partition(':')
+                if not separator or kind.strip().lower() not in KINDS:
+                    yield None, entry, None
+                    continue
+                yield KINDS[kind.strip().lower()], value, reason.strip() or DEFAULT_REASON
+
+
+def build(source, path):
+    """ Compila a lista no arquivo de índice (gravação atômica). Retorna o número de chaves """
+    keys = {}
+    reasons = [DEFAULT_REASON]
+    reason_codes = {DEFAULT_REASON: 0}
+    skipped = 0
+    untyped = 0
+    for kind, value, reason in read_entries(source):
+        if kind is None:
+            untyped += 1
+            continue
+        key = entry_key(kind, value)
+        if key is None:
+            skipped += 1
+            continue
+        if reason not in reason_codes:
+            if len(reasons) == 255:
+                reason = DEFAULT_REASON
+            else:
+                reason_codes[reason] = len(reasons)
+                reasons.append(reason)
+        keys.setdefault(key, reason_codes[reason])
+    if untyped:
+        logger.warning('Lista de supressão %s: %s entradas sem tipo (telefone ou documento) ignoradas.', source, untyped)
+    if skipped:
+        logger.warning('Lista de supressão %s: %s entradas sem dígitos ou longas demais ignoradas.', source, skipped)
+
+    # Tabela com no máximo 50% de ocupação (sondagem linear curta)
+    bits = max(4, (len(keys) * 2 - 1).bit_length())
+    capacity = 1 << bits
+    table = array.array('Q', bytes(capacity * 8))
+    codes = bytearray(capacity)
+    mask = capacity - 1
+    for key, code in keys.items():
+        slot = _slot(key, bits)
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = key
+        codes[slot] = code
+
+    reasons_data = json.dumps(reasons, ensure_ascii=False).encode('utf-8')
+    reasons_data += b'\0' * (-(HEADER.size + len(reasons_data)) % 8)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.suppression', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, capacity, len(keys), len(reasons_data)))
+            file.write(reasons_data)
+            table.tofile(file)
+            file.write(codes)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(keys)
+
+
+class SuppressionIndex:
+    """ Conjunto de telefones e documentos suprimidos de um arquivo de origem, lido do índice mapeado em memória """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, capacity, self.count, reasons_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{path} não é um índice de supressão')
+        self._reasons = json.loads(bytes(self._mmap[HEADER.size:HEADER.size + reasons_size]).rstrip(b'\0'))
+        offset = HEADER.size + reasons_size
+        view = memoryview(self._mmap)
+        self._table = view[offset:offset + capacity * 8].cast('Q')
+        self._codes = view[offset + capacity * 8:offset + capacity * 9]
+        self._bits = capacity.bit_length() - 1
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, key):
+        """ Motivo da chave, ou None se não está na lista """
+        mask = len(self._table) - 1
+        slot = _slot(key, self._bits)
+        while True:
+            stored = self._table[slot]
+            if stored == key:
+                return self._reasons[self._codes[slot]]
+            if not stored:
+                return None
+            slot = (slot + 1) & mask
+
+
+class SuppressionList:
+    """ União dos índices de todos os arquivos de origem """
+
+    def __init__(self, indexes=()):
+        self.indexes = list(indexes)
+
+    def __len__(self):
+        return sum(index.count for index in self.indexes)
+
+    def _lookup(self, key):
+        if key is None:
+            return None
+        for index in self.indexes:
+            reason = index.lookup(key)
+            if reason:
+                return reason
+        return None
+
+    def reason_for(self, phone=None, document=None):
+        """ Motivo da supressão do telefone ou do documento, ou None """
+        return self._lookup(phone_key(phone)) or self._lookup(document_key(document))
+
+    def suppressed_payments(self, payments):
+        """ Consulta em lote: {chave do boleto: motivo} dos pagamentos (models.Payment) suprimidos """
+        if not self.indexes:
+            return {}
+        found = {}
+        for payment in payments:
+            reason = self.reason_for(payment.payer_phone, payment.payer_document)
+            if reason:
+                found[payment.key] = reason
+        return found
+
+    def suppressed_contacts(self, contacts):
+        """ Consulta em lote: {chave do contato: motivo} dos contatos (models.Contact) suprimidos """
+        if not self.indexes:
+            return {}
+        found = {}
+        for contact in contacts:
+            reason = self.reason_for(contact.phone)
+            if reason:
+                found[contact.key] = reason
+        return found
+
+
+def index_path(source):
+    """ Índice do arquivo na versão atual (assinatura do formato, caminho, tamanho e data de modificação) """
+    stat = os.stat(source)
+    # O formato do índice entra na assinatura: uma nova versão não reaproveita índices antigos
+    signature = f'{MAGIC!r}:{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}'
+    digest = hashlib.sha256(signature.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(INDEX_DIR, f'suppression-{digest}.idx')
+
+
+def remove_stale_indexes():
+    for path in glob.glob(os.path.join(INDEX_DIR, 'suppression-*.idx')):
+        try:
+            if time.time() - os.path.getmtime(path) > STALE_INDEX_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(source):
+    """ Abre o índice do arquivo, compilando-o se o arquivo mudou desde a última compilação """
+    path = index_path(source)
+    index = _indexes.get(source)
+    if index is not None and index.path == path:
+        return index
+    # Um só processo compila cada versão; os outros esperam e abrem o arquivo pronto
+    with singleflight.process_lock(path):
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            count = build(source, path)
+            logger.info('Índice de supressão de %s compilado: %s chaves em %.2fs.', source, count, time.perf_counter() - started)
+            remove_stale_indexes()
+        else:
+            # Marca o uso, para a limpeza dos índices antigos
+            os.utime(path)
+    _indexes[source] = SuppressionIndex(path)
+    return _indexes[source]
+
+
+def load():
+    """ Retorna a lista de supressão atual (SuppressionList) """
+    with _indexes_lock:
+        suppression_list = SuppressionList(open_index(source) for source in source_files())
+    metrics.set_gauge('suppression.entries', len(suppression_list))
+    return suppression_list
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import contextlib
+import contextvars
+from datetime import date, datetime
+
+import storage
+
+# Spans no formato do OpenTelemetry gravados em JSON por linha (logs/traces.jsonl), um trace por boleto e dia:
+# classify (find_charge) -> resolve (contact_manager) -> send (send_mensage) -> flow (flow_worker), cada um com as
+# chamadas à API (uma por endpoint, com as tentativas como filhas) e os atributos bucket e http.status_code.
+#   TRACE_ENABLED   1 para gravar os spans (padrão 1)
+#   TRACE_FILE      arquivo de saída (padrão logs/traces.jsonl do bucket)
+TRACE_FILE = os.getenv('TRACE_FILE') or storage.bucket_path('logs', 'traces.jsonl')
+BUCKET = os.path.basename(storage.BASE_DIR)
+
+_current = contextvars.ContextVar('current_span', default=None)
+_file = None
+_file_lock = threading.Lock()
+
+
+def enabled():
+    return os.getenv('TRACE_ENABLED', '1') == '1'
+
+
+def trace_id_for(key, day=None):
+    """ Trace do boleto no dia: o mesmo id em todas as etapas e processos, sem precisar propagar contexto """
+    return hashlib.sha256(f'{key}|{(day or date.today()).isoformat()}'.encode('utf-8')).hexdigest()[:32]
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_span_id', 'name', 'start', 'attributes', 'status')
+
+    def __init__(self, trace_id, parent_span_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.start = time.time()
+        self.attributes = attributes
+        self.status = 'OK'
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def to_dict(self, end):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_span_id,
+            'name': self.name,
+            'start_time': datetime.fromtimestamp(self.start).isoformat(timespec='microseconds'),
+            'end_time': datetime.fromtimestamp(end).isoformat(timespec='microseconds'),
+            'duration_ms': round((end - self.start) * 1000, 3),
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+
+def _export(data):
+    global _file
+    line = json.dumps(data, ensure_ascii=False, default=str) + '\n'
+    with _file_lock:
+        if _file is None:
+            os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+            _file = open(TRACE_FILE, 'a', encoding='utf-8')
+            atexit.register(close)
+        _file.write(line)
+
+
+@contextlib.contextmanager
+def span(name, trace_key=None, **attributes):
+    """ Abre um span filho do span atual ou, com trace_key (chave do boleto), a raiz de uma etapa no trace do boleto.
+    Sem trace_key e sem span atual (chamada fora de um boleto) não grava nada e retorna None """
+    parent = _current.get()
+    if not enabled() or (trace_key is None and parent is None):
+        yield None
+        return
+
+    if trace_key is not None:
+        trace_id = trace_id_for(trace_key)
+        parent_span_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+        current = Span(trace_id, parent_span_id, name, {'bucket': BUCKET, 'boleto_key': trace_key, **attributes})
+    else:
+        current = Span(parent.trace_id, parent.span_id, name, {'bucket': BUCKET, **attributes})
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = 'ERROR'
+        current.attributes['exception.type'] = type(e).__name__
+        current.attributes['exception.message'] = str(e)[:200]
+        raise
+    finally:
+        _current.reset(token)
+        _export(current.to_dict(time.time()))
+
+
+def record(name, trace_key, start, end, **attributes):
+    """ Grava um span já medido (ex.: parte de um processamento em lote), como raiz de uma etapa no trace do boleto """
+    if not enabled():
+        return
+    current = Span(trace_id_for(trace_key), None, name, {'bucket': BUCKET, 'boleto_key': trace_key, **attributes})
+    current.start = start
+    _export(current.to_dict(end))
+
+
+def set_attribute(name, value):
+    """ Atributo no span atual, se houver """
+    current = _current.get()
+    if current is not None:
+        current.set_attribute(name, value)
+
+
+def close():
+    global _file
+    with _file_lock:
+        if _file is not None:
+            _file.close()
+            _file = None
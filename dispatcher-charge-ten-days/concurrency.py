@@ -0,0 +1,142 @@
+import os
+import math
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Controle adaptativo (AIMD) de chamadas simultâneas por serviço, aplicado em http_client.request:
+# sobe 1 a cada janela saudável em que o limite foi usado por inteiro e cai pela metade em 429, timeout ou 5xx.
+# Latência p95 acima de CONCURRENCY_LATENCY_TOLERANCE (padrão 2) vezes a menor já observada também reduz o limite (10%),
+# pois indica fila no provedor antes de ele começar a recusar.
+#   ADAPTIVE_CONCURRENCY_SERVICES   serviços controlados, separados por vírgula (padrão sendpulse; vazio desliga)
+#   CONCURRENCY_INITIAL / _MIN / _MAX   limite inicial e faixa permitida (padrão 4, 1 e 32)
+DEFAULT_SERVICES = 'sendpulse'
+DEFAULT_INITIAL = 4
+DEFAULT_MIN = 1
+DEFAULT_MAX = 32
+DEFAULT_WINDOW = 20
+DEFAULT_LATENCY_TOLERANCE = 2.0
+DEFAULT_MAX_ERROR_RATE = 0.05
+BACKOFF_FACTOR = 0.5
+LATENCY_BACKOFF_FACTOR = 0.9
+# A menor latência observada sobe um pouco a cada janela, para acompanhar mudanças normais do provedor
+BASELINE_DRIFT = 1.05
+
+
+def _p95(values):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * 0.95) - 1)]
+
+
+class AdaptiveLimiter:
+    """ Limite de chamadas simultâneas ajustado pela latência e pelas falhas observadas """
+
+    def __init__(self, name, initial=DEFAULT_INITIAL, min_limit=DEFAULT_MIN, max_limit=DEFAULT_MAX,
+                 window=DEFAULT_WINDOW, latency_tolerance=DEFAULT_LATENCY_TOLERANCE, max_error_rate=DEFAULT_MAX_ERROR_RATE):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.baseline = None
+        self._samples = []
+        self._peak_in_flight = 0
+        self._since_decrease = None
+        self._condition = threading.Condition()
+        metrics.set_gauge(f'{name}.concurrency', int(self.limit))
+
+    def acquire(self):
+        """ Espera uma vaga dentro do limite atual """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self.in_flight)
+
+    def release(self, latency, overloaded):
+        """ Libera a vaga e registra o resultado da chamada (overloaded: 429, timeout, falha de conexão ou 5xx) """
+        with self._condition:
+            self.in_flight -= 1
+            self._samples.append((latency, overloaded))
+            if self._since_decrease is not None:
+                self._since_decrease += 1
+            if overloaded and self._can_decrease():
+                self._set_limit(self.limit * BACKOFF_FACTOR, 'sobrecarga (429, timeout ou 5xx)')
+            elif len(self._samples) >= self.window:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _can_decrease(self):
+        # As chamadas que já estavam em andamento na última redução não contam de novo
+        return self._since_decrease is None or self._since_decrease >= int(self.limit)
+
+    def _adjust(self):
+        latencies = [latency for latency, _ in self._samples]
+        error_rate = sum(1 for _, overloaded in self._samples if overloaded) / len(self._samples)
+        p95 = _p95(latencies)
+        self.baseline = p95 if self.baseline is None else min(p95, self.baseline * BASELINE_DRIFT)
+        detail = f'p95 {p95:.2f}s, base {self.baseline:.2f}s, erros {error_rate:.0%}'
+
+        if error_rate > self.max_error_rate or p95 > self.baseline * self.latency_tolerance:
+            if not self._can_decrease():
+                self._samples = []
+            elif error_rate > self.max_error_rate:
+                self._set_limit(self.limit * BACKOFF_FACTOR, detail)
+            else:
+                self._set_limit(self.limit * LATENCY_BACKOFF_FACTOR, 'latência alta: ' + detail)
+        elif self._peak_in_flight >= int(self.limit):
+            # Só aumenta se o limite atual foi de fato usado
+            self._set_limit(self.limit + 1, detail, decrease=False)
+        else:
+            self._samples = []
+        self._peak_in_flight = self.in_flight
+
+    def _set_limit(self, value, reason, decrease=True):
+        previous = int(self.limit)
+        self.limit = min(max(value, self.min_limit), self.max_limit)
+        self._samples = []
+        if decrease:
+            self._since_decrease = 0
+            metrics.incr(f'{self.name}.concurrency_decreases')
+        if int(self.limit) != previous:
+            if decrease:
+                logger.warning("Concorrência '%s': %d -> %d (%s)", self.name, previous, int(self.limit), reason)
+            else:
+                logger.info("Concorrência '%s': %d -> %d (%s)", self.name, previous, int(self.limit), reason,
+                            extra={'sample': 'concurrency_increase'})
+            metrics.set_gauge(f'{self.name}.concurrency', int(self.limit))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def max_concurrency():
+    return int(os.getenv('CONCURRENCY_MAX', DEFAULT_MAX))
+
+
+def is_adaptive(service):
+    services = os.getenv('ADAPTIVE_CONCURRENCY_SERVICES', DEFAULT_SERVICES)
+    return service in {name.strip() for name in services.split(',')}
+
+
+def get_limiter(service):
+    """ Retorna o limitador do serviço, ou None se o serviço não tem controle adaptativo """
+    if not is_adaptive(service):
+        return None
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = AdaptiveLimiter(
+                service,
+                int(os.getenv('CONCURRENCY_INITIAL', DEFAULT_INITIAL)),
+                int(os.getenv('CONCURRENCY_MIN', DEFAULT_MIN)),
+                max_concurrency(),
+                latency_tolerance=float(os.getenv('CONCURRENCY_LATENCY_TOLERANCE', DEFAULT_LATENCY_TOLERANCE))
+            )
+        return _limiters[service]
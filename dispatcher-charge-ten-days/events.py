@@ -0,0 +1,195 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import storage
+
+# Eventos recebidos da SendPulse por webhook (entrega, leitura, respostas e cliques nos botões),
+# compartilhados pelos quatro buckets (SQLite na raiz do repositório).
+EVENTS_FILE = storage.root_path('historico', 'events.db')
+
+KIND_REPLY = 'reply'
+KIND_DELIVERED = 'delivered'
+KIND_READ = 'read'
+KIND_UNDELIVERED = 'undelivered'
+KIND_OTHER = 'other'
+KINDS = (KIND_REPLY, KIND_DELIVERED, KIND_READ, KIND_UNDELIVERED, KIND_OTHER)
+
+# Títulos de evento da SendPulse que indicam resposta do contato (mensagem ou clique em botão)
+REPLY_TITLES = {'incoming_message', 'incoming_button', 'button_click', 'quick_reply'}
+UNDELIVERED_STATUSES = {'failed', 'undelivered', 'error', 'rejected'}
+
+_connection = None
+_lock = threading.Lock()
+
+
+class InvalidEventError(ValueError):
+    """ Evento com campos em formato inesperado (ex.: contact que não é um objeto) """
+
+
+def validate(event):
+    """ Confere o tipo dos campos usados na classificação e na gravação. Lança InvalidEventError """
+    if not isinstance(event, dict):
+        raise InvalidEventError('evento não é um objeto')
+    for field in ('contact', 'info', 'data'):
+        if event.get(field) is not None and not isinstance(event[field], dict):
+            raise InvalidEventError(f'campo {field} não é um objeto')
+    message = (event.get('info') or {}).get('message')
+    if message is not None and not isinstance(message, dict):
+        raise InvalidEventError('campo info.message não é um objeto')
+    for field in ('title', 'event'):
+        if event.get(field) is not None and not isinstance(event[field], str):
+            raise InvalidEventError(f'campo {field} não é texto')
+    contact = event.get('contact') or {}
+    for value in (contact.get('id'), contact.get('phone'), event.get('contact_id'), event.get('phone')):
+        if value is not None and not isinstance(value, (str, int)):
+            raise InvalidEventError('id ou telefone do contato em formato inválido')
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(EVENTS_FILE), exist_ok=True)
+        _connection = sqlite3.connect(EVENTS_FILE, timeout=30, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        with _connection:
+            _connection.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    contact_id TEXT,
+                    phone TEXT,
+                    kind TEXT NOT NULL,
+                    title TEXT,
+                    status TEXT,
+                    event_at TEXT,
+                    received_at TEXT NOT NULL,
+                    payload TEXT NOT NULL
+                )""")
+            _connection.execute('CREATE INDEX IF NOT EXISTS events_contact ON events (contact_id, kind, received_at)')
+            _connection.execute('CREATE INDEX IF NOT EXISTS events_phone ON events (phone, received_at)')
+    return _connection
+
+
+def _status(event):
+    """ Status de entrega, se o evento trouxer um (o formato varia entre os tipos de evento) """
+    for container in (event.get('info') or {}, (event.get('info') or {}).get('message') or {}, event.get('data') or {}, event):
+        if isinstance(container, dict) and isinstance(container.get('status'), str):
+            return container['status'].lower()
+    return None
+
+
+def classify(event):
+    """ Tipo do evento para as regras de envio """
+    title = (event.get('title') or event.get('event') or '').lower()
+    status = _status(event)
+    if title in REPLY_TITLES:
+        return KIND_REPLY
+    if status in UNDELIVERED_STATUSES:
+        return KIND_UNDELIVERED
+    if status == 'read':
+        return KIND_READ
+    if status in ('delivered', 'sent'):
+        return KIND_DELIVERED
+    return KIND_OTHER
+
+
+def _event_at(event):
+    value = event.get('date') or event.get('created_at')
+    if isinstance(value, (int, float)):
+        # Timestamp em segundos ou milissegundos
+        try:
+            return datetime.fromtimestamp(value / 1000 if value > 10 ** 11 else value).isoformat(timespec='seconds')
+        except (OverflowError, OSError, ValueError):
+            raise InvalidEventError(f'data inválida: {value}')
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def store(raw_events):
+    """ Grava os eventos recebidos pelo webhook. Retorna quantos foram gravados.
+    Lança InvalidEventError (sem gravar nada do lote) se algum evento tiver campos em formato inesperado """
+    now = datetime.now().isoformat(timespec='seconds')
+    rows = []
+    for event in raw_events:
+        if not isinstance(event, dict):
+            continue
+        validate(event)
+        contact = event.get('contact') or {}
+        rows.append((contact.get('id') or event.get('contact_id'), contact.get('phone') or event.get('phone'),
+                     classify(event), event.get('title'), _status(event), _event_at(event), now,
+                     json.dumps(event, ensure_ascii=False)))
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.executemany(
+                'INSERT INTO events (contact_id, phone, kind, title, status, event_at, received_at, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def latest_kinds(contact_ids, since):
+    """ {contact_id: {tipo: último recebimento}} dos eventos desde since (datetime), em lotes """
+    ids = list({contact_id for contact_id in contact_ids if contact_id})
+    result = {}
+    if not ids or not os.path.exists(EVENTS_FILE):
+        return result
+    with _lock:
+        connection = _connect()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = connection.execute(
+                f'SELECT contact_id, kind, MAX(received_at) FROM events '
+                f'WHERE contact_id IN ({placeholders}) AND received_at >= ? GROUP BY contact_id, kind',
+                [*batch, since.isoformat(timespec='seconds')]).fetchall()
+            for contact_id, kind, received_at in rows:
+                result.setdefault(contact_id, {})[kind] = received_at
+    return result
+
+
+def skip_reasons(contacts, now=None):
+    """ Contatos para os quais um novo envio é inútil: responderam recentemente (SKIP_IF_REPLIED_DAYS, padrão 7; 0 desliga)
+    ou cuja última mensagem não foi entregue (SKIP_IF_UNDELIVERED=1, padrão). Retorna {contact.key: motivo} """
+    now = now or datetime.now()
+    replied_days = float(os.getenv('SKIP_IF_REPLIED_DAYS', 7))
+    skip_undelivered = os.getenv('SKIP_IF_UNDELIVERED', '1') == '1'
+    lookback = max(replied_days, 30)
+    kinds = latest_kinds((contact.contact_id for contact in contacts), now - timedelta(days=lookback))
+
+    reasons = {}
+    replied_since = (now - timedelta(days=replied_days)).isoformat(timespec='seconds')
+    for contact in contacts:
+        latest = kinds.get(contact.contact_id)
+        if not latest:
+            continue
+        if replied_days > 0 and latest.get(KIND_REPLY, '') >= replied_since:
+            reasons[contact.key] = 'respondeu em ' + latest[KIND_REPLY]
+        elif skip_undelivered and KIND_UNDELIVERED in latest and latest[KIND_UNDELIVERED] > max(
+                latest.get(KIND_DELIVERED, ''), latest.get(KIND_READ, ''), latest.get(KIND_REPLY, '')):
+            reasons[contact.key] = 'última mensagem não entregue em ' + latest[KIND_UNDELIVERED]
+    return reasons
+
+
+def query(contact_id=None, phone=None, kind=None, since=None, limit=50):
+    """ Eventos mais recentes primeiro, com filtros opcionais """
+    conditions, params = [], []
+    for column, value in (('contact_id', contact_id), ('phone', phone), ('kind', kind)):
+        if value:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    if since:
+        conditions.append('received_at >= ?')
+        params.append(since.isoformat(timespec='seconds'))
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    with _lock:
+        return _connect().execute(
+            f'SELECT id, contact_id, phone, kind, title, status, event_at, received_at FROM events{where} '
+            f'ORDER BY received_at DESC, id DESC LIMIT ?', [*params, limit]).fetchall()
+
+
+def summary(since=None):
+    """ Quantidade de eventos por tipo """
+    where, params = ('WHERE received_at >= ?', [since.isoformat(timespec='seconds')]) if since else ('', [])
+    with _lock:
+        return dict(_connect().execute(f'SELECT kind, COUNT(*) FROM events {where} GROUP BY kind', params).fetchall())
@@ -0,0 +1,71 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta
+
+import storage
+
+NEGATIVE_CACHE_FILE = storage.bucket_path('contatos', 'negative_cache.json')
+
+# Tempo de bloqueio após a primeira falha; dobra a cada nova falha até o máximo
+# (NEGATIVE_CACHE_TTL_HOURS e NEGATIVE_CACHE_MAX_TTL_HOURS no .env)
+DEFAULT_TTL_HOURS = 24
+DEFAULT_MAX_TTL_HOURS = 24 * 30
+
+_entries = None
+_lock = threading.Lock()
+
+
+def _load():
+    global _entries
+    if _entries is None:
+        if os.path.exists(NEGATIVE_CACHE_FILE):
+            with open(NEGATIVE_CACHE_FILE, 'r', encoding='utf-8') as file:
+                _entries = json.load(file)
+        else:
+            _entries = {}
+    return _entries
+
+
+def get(phone_number):
+    """ Retorna a entrada do telefone se ele ainda estiver bloqueado, senão None """
+    with _lock:
+        entry = _load().get(phone_number)
+        if entry and datetime.fromisoformat(entry['expires_at']) > datetime.now():
+            return entry
+        return None
+
+
+def record_failure(phone_number, reason):
+    """ Registra uma falha permanente para o telefone, com TTL exponencial """
+    ttl_hours = float(os.getenv('NEGATIVE_CACHE_TTL_HOURS', DEFAULT_TTL_HOURS))
+    max_ttl_hours = float(os.getenv('NEGATIVE_CACHE_MAX_TTL_HOURS', DEFAULT_MAX_TTL_HOURS))
+
+    with _lock:
+        entries = _load()
+        failures = entries.get(phone_number, {}).get('failures', 0) + 1
+        now = datetime.now()
+        ttl = timedelta(hours=min(max_ttl_hours, ttl_hours * (2 ** (failures - 1))))
+        entries[phone_number] = {
+            'reason': reason,
+            'failures': failures,
+            'failed_at': now.isoformat(timespec='seconds'),
+            'expires_at': (now + ttl).isoformat(timespec='seconds')
+        }
+
+
+def clear(phone_number):
+    """ Remove o telefone do cache (contato resolvido com sucesso) """
+    with _lock:
+        _load().pop(phone_number, None)
+
+
+def save():
+    """ Persiste o cache, descartando entradas expiradas há mais do que o TTL máximo """
+    max_ttl_hours = float(os.getenv('NEGATIVE_CACHE_MAX_TTL_HOURS', DEFAULT_MAX_TTL_HOURS))
+    limit = datetime.now() - timedelta(hours=max_ttl_hours)
+
+    with _lock:
+        entries = {phone: entry for phone, entry in _load().items()
+                   if datetime.fromisoformat(entry['expires_at']) > limit}
+        storage.write_json(NEGATIVE_CACHE_FILE, entries)
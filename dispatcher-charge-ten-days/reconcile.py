@@ -0,0 +1,47 @@
+import os
+import logging
+from dotenv import load_dotenv
+
+import find_charge
+import log_setup
+import metrics
+import profiling
+import send_history
+import storage
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+# Status da Clinicorp que contam como pago (PAID_STATUSES no .env, separados por vírgula)
+DEFAULT_PAID_STATUSES = 'PAID,SETTLED,RECEIVED'
+
+REPORT_FILE = storage.bucket_path('debitos', 'reconciliation.json')
+METRICS_FILE = storage.bucket_path('metricas', 'reconcile.json')
+
+# Configuração de logging
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+def paid_statuses():
+    return {status.strip() for status in os.getenv('PAID_STATUSES', DEFAULT_PAID_STATUSES).split(',') if status.strip()}
+
+
+def main():
+    """ Marca no histórico os boletos pagos depois de um lembrete, para que nenhum bucket volte a tratá-los """
+    # Mesma consulta do find_charge: normalmente vem do cache de respostas, sem nova chamada à API
+    payments = find_charge.get_monthly_payments()
+    if not payments:
+        logger.warning("Nenhum pagamento retornado pela Clinicorp. Conciliação não realizada.")
+        return
+
+    settled = send_history.reconcile(payments, paid_statuses())
+    metrics.incr('reconcile.settled', len(settled))
+    logger.info("Conciliação: %d boletos pagos após lembrete marcados como quitados.", len(settled))
+
+    storage.write_json(REPORT_FILE, {'settled': settled})
+    metrics.dump(METRICS_FILE, 'reconcile')
+
+
+if __name__ == "__main__":
+    profiling.run_stage('reconcile', main)
@@ -0,0 +1,90 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import tempfile
+
+import metrics
+import storage
+from retry import request_with_retry
+
+logger = logging.getLogger(__name__)
+
+# Pasta compartilhada pelos quatro dispatchers: a mesma consulta da Clinicorp serve a todos os buckets
+CACHE_DIR = storage.root_path('cache', 'clinicorp')
+
+# Tempo (segundos) em que uma resposta salva é usada sem consultar a API (CLINICORP_CACHE_TTL no .env)
+DEFAULT_TTL = 1800
+
+
+def cache_key(url, params):
+    """ Chave da resposta: hash da URL e dos parâmetros da requisição """
+    raw = json.dumps([url, sorted((params or {}).items())], default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key + '.json.gz')
+
+
+def load(key):
+    """ Retorna a entrada salva ({stored_at, etag, last_modified, data}) ou None """
+    try:
+        with gzip.open(_path(key), 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def store(key, entry):
+    """ Grava a entrada comprimida de forma atômica (arquivo temporário + rename) """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with gzip.open(os.fdopen(fd, 'wb'), 'wt', encoding='utf-8') as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp_path, _path(key))
+    except OSError as e:
+        logger.warning("Não foi possível salvar a resposta em cache: %s", e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def cached_get_json(endpoint, url, params, headers, use_cache=True):
+    """ GET com cache em disco: usa a resposta salva enquanto estiver fresca e,
+    depois disso, revalida com If-None-Match / If-Modified-Since quando o servidor os suporta """
+    key = cache_key(url, params)
+    entry = load(key) if use_cache else None
+    ttl = float(os.getenv('CLINICORP_CACHE_TTL', DEFAULT_TTL))
+
+    if entry and time.time() - entry['stored_at'] < ttl:
+        metrics.incr(f'{endpoint}.cache_hits')
+        return entry['data']
+
+    request_headers = dict(headers)
+    request_headers.setdefault('Accept-Encoding', 'gzip')
+    if entry and entry.get('etag'):
+        request_headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        request_headers['If-Modified-Since'] = entry['last_modified']
+
+    response = request_with_retry(endpoint, 'GET', url, params=params, headers=request_headers)
+
+    if response.status_code == 304 and entry:
+        metrics.incr(f'{endpoint}.cache_revalidated')
+        entry['stored_at'] = time.time()
+        store(key, entry)
+        return entry['data']
+
+    response.raise_for_status()
+    data = response.json()
+    metrics.incr(f'{endpoint}.cache_misses')
+    store(key, {
+        'stored_at': time.time(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'data': data
+    })
+    return data
@@ -0,0 +1,186 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import http_client
+import metrics
+import tracing
+from http_client import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Status HTTP que indicam falha transitória (vale tentar novamente)
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# Chamadas que não podem ser repetidas às cegas: se a SendPulse chegou a executá-las, repetir manda outro WhatsApp
+# ao paciente, cria um contato duplicado ou roda o fluxo de novo. Só são repetidas quando a requisição comprovadamente
+# não chegou ao servidor (falha ao conectar) ou foi recusada sem ser executada (429/503; o Retry-After, se vier, só define
+# a espera). Timeout de leitura e demais 5xx têm resultado desconhecido: viram UnknownOutcomeError, sem nova tentativa
+NON_IDEMPOTENT_ENDPOINTS = {'sendpulse.create_contact', 'sendpulse.send_template', 'sendpulse.flows_run'}
+REJECTED_STATUS = {429, 503}
+
+# Política padrão (RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY e RETRY_BUDGET no .env)
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_RETRY_BUDGET = 200
+
+
+class RetryExhaustedError(requests.exceptions.RequestException):
+    """ Falha transitória que persistiu após todas as tentativas """
+
+    def __init__(self, message, attempts, response=None):
+        super().__init__(message, response=response)
+        self.attempts = attempts
+
+
+class UnknownOutcomeError(RetryExhaustedError):
+    """ Chamada não idempotente sem resultado conhecido (timeout de leitura ou 5xx): pode ter sido executada, não é repetida """
+
+
+class RetryBudget:
+    """ Limite de novas tentativas por execução, para não transformar uma instabilidade em tempestade de chamadas """
+
+    def __init__(self, total):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def consume(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = RetryBudget(int(os.getenv('RETRY_BUDGET', DEFAULT_RETRY_BUDGET)))
+        return _budget
+
+
+def worst_case_seconds(endpoint):
+    """ Duração máxima de request_with_retry para o endpoint: todas as tentativas esgotando os timeouts de conexão
+    e de leitura, mais a espera máxima entre elas (sem contar a fila do limite de concorrência) """
+    max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
+    max_delay = float(os.getenv('RETRY_MAX_DELAY', DEFAULT_MAX_DELAY))
+    connect, read = http_client.get_timeout(endpoint)
+    return max_attempts * (connect + read) + (max_attempts - 1) * max_delay
+
+
+def is_idempotent(endpoint):
+    return endpoint not in NON_IDEMPOTENT_ENDPOINTS
+
+
+def never_reached_server(error):
+    """ Falha ao abrir a conexão: a requisição não foi enviada """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and not isinstance(error, requests.exceptions.Timeout):
+        # Conexão recusada / DNS (urllib3 NewConnectionError); "Connection aborted" pode ter ocorrido após o envio
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def is_retryable_error(error, endpoint=None):
+    """ Classifica exceções de rede: timeouts e falhas de conexão são transitórios.
+    Em chamadas não idempotentes só a falha ao conectar é repetida """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if endpoint is not None and not is_idempotent(endpoint):
+        return never_reached_server(error)
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+
+def is_retryable_response(response, endpoint=None):
+    if endpoint is not None and not is_idempotent(endpoint):
+        return response.status_code in REJECTED_STATUS
+    return response.status_code in RETRYABLE_STATUS
+
+
+def is_unknown_outcome(endpoint, error=None, response=None):
+    """ Chamada não idempotente que pode ter sido executada pelo servidor apesar da falha """
+    if is_idempotent(endpoint):
+        return False
+    if error is not None:
+        return not isinstance(error, CircuitOpenError) and isinstance(
+            error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+    return response.status_code >= 500
+
+
+def backoff_delay(attempt, base_delay, max_delay, retry_after=None):
+    """ Backoff exponencial com jitter completo; respeita o Retry-After enviado pelo servidor """
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+    if retry_after:
+        try:
+            delay = max(delay, min(max_delay, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
+def request_with_retry(endpoint, method, url, **kwargs):
+    """ Faz a requisição via http_client repetindo falhas transitórias.
+    Respostas com erro permanente (ex.: 400) são retornadas normalmente para o chamador tratar.
+    Lança RetryExhaustedError quando as tentativas acabam, UnknownOutcomeError quando uma chamada não idempotente
+    pode ter sido executada (não é repetida) e CircuitOpenError quando o serviço está fora. """
+    # No trace do boleto: um span por endpoint, com cada tentativa (http_client) como filha
+    with tracing.span(endpoint):
+        return _request_with_retry(endpoint, method, url, **kwargs)
+
+
+def _request_with_retry(endpoint, method, url, **kwargs):
+    max_attempts = int(os.getenv('RETRY_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS))
+    base_delay = float(os.getenv('RETRY_BASE_DELAY', DEFAULT_BASE_DELAY))
+    max_delay = float(os.getenv('RETRY_MAX_DELAY', DEFAULT_MAX_DELAY))
+
+    attempt = 0
+    while True:
+        attempt += 1
+        tracing.set_attribute('retry.attempts', attempt)
+        response = None
+        try:
+            response = http_client.request(endpoint, method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if not is_retryable_error(e, endpoint):
+                if is_unknown_outcome(endpoint, error=e):
+                    raise _unknown_outcome(endpoint, attempt, e)
+                raise
+            last_error = str(e)
+        else:
+            tracing.set_attribute('http.status_code', response.status_code)
+            if not is_retryable_response(response, endpoint):
+                if is_unknown_outcome(endpoint, response=response):
+                    raise _unknown_outcome(endpoint, attempt, f'status {response.status_code}', response)
+                return response
+            last_error = f'status {response.status_code}'
+
+        if attempt >= max_attempts or not get_budget().consume():
+            metrics.incr(f'{endpoint}.retry_exhausted')
+            raise RetryExhaustedError(
+                f'{endpoint}: falha após {attempt} tentativas ({last_error})', attempt, response=response)
+
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        delay = backoff_delay(attempt, base_delay, max_delay, retry_after)
+        metrics.incr(f'{endpoint}.retries')
+        logger.warning("%s: tentativa %d/%d falhou (%s). Nova tentativa em %.1fs",
+                       endpoint, attempt, max_attempts, last_error, delay)
+        time.sleep(delay)
+
+
+def _unknown_outcome(endpoint, attempt, error, response=None):
+    metrics.incr(f'{endpoint}.unknown_outcome')
+    return UnknownOutcomeError(
+        f'{endpoint}: resultado desconhecido na tentativa {attempt} ({error}); não repetido para não duplicar', attempt,
+        response=response)
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import storage
+
+# Histórico de envios compartilhado pelos quatro buckets (SQLite na raiz do repositório).
+# Usado para priorizar boletos que ainda não receberam lembrete e, na conciliação (reconcile.py),
+# para saber quais boletos foram pagos depois de um lembrete.
+HISTORY_FILE = storage.root_path('historico', 'send_history.db')
+BUCKET = os.path.basename(storage.BASE_DIR)
+
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+
+_connection = None
+_lock = threading.Lock()
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+        _connection = sqlite3.connect(HISTORY_FILE, timeout=30, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        with _connection:
+            _connection.execute("""
+                CREATE TABLE IF NOT EXISTS sends (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    bucket TEXT NOT NULL,
+                    boleto_key TEXT NOT NULL,
+                    digital_line TEXT,
+                    contact_id TEXT,
+                    phone TEXT,
+                    due_date TEXT,
+                    amount REAL,
+                    status TEXT NOT NULL,
+                    sent_at TEXT NOT NULL
+                )""")
+            _connection.execute('CREATE INDEX IF NOT EXISTS sends_boleto_key ON sends (boleto_key, status)')
+            _connection.execute('CREATE INDEX IF NOT EXISTS sends_digital_line ON sends (digital_line, status)')
+            _connection.execute("""
+                CREATE TABLE IF NOT EXISTS settled (
+                    digital_line TEXT PRIMARY KEY,
+                    external_status TEXT,
+                    amount REAL,
+                    reminders INTEGER NOT NULL,
+                    first_sent_at TEXT NOT NULL,
+                    last_sent_at TEXT NOT NULL,
+                    detected_at TEXT NOT NULL
+                )""")
+    return _connection
+
+
+def record(contact, status):
+    """ Registra o resultado do envio do template para o contato (models.Contact). Retorna o id do registro """
+    row = (BUCKET, contact.boleto_key, contact.digital_line, contact.contact_id, contact.phone,
+           contact.due_date, contact.amount, status, datetime.now().isoformat(timespec='seconds'))
+    with _lock:
+        connection = _connect()
+        with connection:
+            cursor = connection.execute(
+                'INSERT INTO sends (bucket, boleto_key, digital_line, contact_id, phone, due_date, amount, status, sent_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        return cursor.lastrowid
+
+
+def sent_counts(boleto_keys):
+    """ Quantos lembretes cada boleto já recebeu (em qualquer bucket) """
+    keys = list({key for key in boleto_keys if key})
+    counts = {}
+    with _lock:
+        connection = _connect()
+        # Em lotes para respeitar o limite de parâmetros do SQLite
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = connection.execute(
+                f'SELECT boleto_key, COUNT(*) FROM sends WHERE status = ? AND boleto_key IN ({placeholders}) GROUP BY boleto_key',
+                [STATUS_SENT, *batch]).fetchall()
+            counts.update(rows)
+    return counts
+
+
+def reconcile(payments, paid_statuses):
+    """ Junta a lista atual da Clinicorp (models.Payment) com o histórico pela linha digitável e marca como quitados
+    os boletos com status em paid_statuses que receberam lembrete. Retorna as linhas digitáveis marcadas agora """
+    rows = [(payment.digital_line, payment.external_status, payment.amount)
+            for payment in payments if payment.digital_line and payment.external_status in paid_statuses]
+    now = datetime.now().isoformat(timespec='seconds')
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS current_paid '
+                               '(digital_line TEXT PRIMARY KEY, external_status TEXT, amount REAL)')
+            connection.execute('DELETE FROM current_paid')
+            connection.executemany('INSERT OR REPLACE INTO current_paid VALUES (?, ?, ?)', rows)
+            # Junção indexada: current_paid pela chave primária, sends por (digital_line, status)
+            new_lines = [line for line, in connection.execute(
+                'SELECT DISTINCT c.digital_line FROM current_paid c '
+                'JOIN sends s ON s.digital_line = c.digital_line AND s.status = ? '
+                'WHERE c.digital_line NOT IN (SELECT digital_line FROM settled)', (STATUS_SENT,))]
+            connection.execute(
+                'INSERT OR IGNORE INTO settled (digital_line, external_status, amount, reminders, first_sent_at, last_sent_at, detected_at) '
+                'SELECT c.digital_line, c.external_status, c.amount, COUNT(*), MIN(s.sent_at), MAX(s.sent_at), ? '
+                'FROM current_paid c JOIN sends s ON s.digital_line = c.digital_line AND s.status = ? '
+                'GROUP BY c.digital_line', (now, STATUS_SENT))
+    return new_lines
+
+
+def settled_lines(digital_lines):
+    """ Quais destas linhas digitáveis já foram marcadas como quitadas após lembrete """
+    lines = list({line for line in digital_lines if line})
+    settled = set()
+    with _lock:
+        connection = _connect()
+        for start in range(0, len(lines), 500):
+            batch = lines[start:start + 500]
+            placeholders = ','.join('?' * len(batch))
+            settled.update(line for line, in connection.execute(
+                f'SELECT digital_line FROM settled WHERE digital_line IN ({placeholders})', batch))
+    return settled
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -0,0 +1,61 @@
+import os
+import json
+import fcntl
+import tempfile
+import contextlib
+
+# Caminhos a partir da pasta do dispatcher, e não do diretório de trabalho do processo:
+# os quatro buckets podem rodar em paralelo, de qualquer lugar, sem gravar nos arquivos uns dos outros.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+LOCK_FILE = os.path.join(BASE_DIR, 'automaticRun.lock')
+
+
+class BucketLockedError(RuntimeError):
+    """ Outra execução deste bucket já está em andamento """
+
+
+def bucket_path(*parts):
+    """ Caminho dentro da pasta deste dispatcher """
+    return os.path.join(BASE_DIR, *parts)
+
+
+def root_path(*parts):
+    """ Caminho na raiz do repositório (pastas compartilhadas pelos buckets, ex.: cache) """
+    return os.path.join(ROOT_DIR, *parts)
+
+
+def write_json(path, data, indent=4):
+    """ Grava o JSON de forma atômica (arquivo temporário na mesma pasta + rename):
+    quem lê nunca vê o arquivo pela metade, mesmo se o processo for interrompido """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, indent=indent, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def bucket_lock():
+    """ Impede duas execuções simultâneas do mesmo bucket. O lock é liberado pelo sistema
+    operacional se o processo morrer, então não sobra arquivo travado """
+    file = open(LOCK_FILE, 'a+', encoding='utf-8')
+    try:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.seek(0)
+            raise BucketLockedError(f'{os.path.basename(BASE_DIR)} já está em execução ({file.read().strip() or "pid desconhecido"})')
+        file.seek(0)
+        file.truncate()
+        file.write(f'pid {os.getpid()}\n')
+        file.flush()
+        yield
+    finally:
+        file.close()
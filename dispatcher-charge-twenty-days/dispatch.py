@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from datetime import date
+from dotenv import load_dotenv
+
+import contact_index
+import contact_manager
+import dead_letter
+import find_charge
+import log_setup
+import metrics
+import negative_cache
+import profiling
+import run_lock
+import send_mensage
+import send_queue
+import storage
+from models import Contact, Payment, format_phone_number, parse_due_date, parse_payments
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+# Reprocessamento pontual de uma etapa, só para os boletos/contatos filtrados, sem refazer a execução inteira:
+#   fetch     busca os boletos na Clinicorp e grava debitos/listDebit.json; com filtros grava só os filtrados em
+#             debitos/dispatch_fetch.json, sem mexer na lista do dia
+#   resolve   resolve os contatos na SendPulse e coloca os resolvidos na fila de envio
+#   send      envia os contatos da fila
+#   run       fetch + resolve + send
+# Exemplos:
+#   python3 dispatch.py resolve --status failed
+#   python3 dispatch.py send --status dead-lettered --phone 5511999990000
+#   python3 dispatch.py run --line 23793381286000000001234567890123456789012345 --dry-run
+STATUS_FAILED = 'failed'
+STATUS_DEAD_LETTERED = 'dead-lettered'
+
+# Resultado de um fetch filtrado (a lista do dia, listDebit.json, só é regravada por um fetch sem filtros)
+FILTERED_FETCH_FILE = 'dispatch_fetch.json'
+
+METRICS_FILE = storage.bucket_path('metricas', 'dispatch.json')
+
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+def _digits(value):
+    return ''.join(filter(str.isdigit, value or ''))
+
+
+def _date(value):
+    return date.fromisoformat(value)
+
+
+def add_filters(parser, with_status=True):
+    parser.add_argument('--phone', action='append', metavar='TELEFONE', help='telefone (repetível)')
+    parser.add_argument('--line', action='append', metavar='LINHA', help='BoletoDigitalLine (repetível)')
+    parser.add_argument('--from', dest='date_from', type=_date, metavar='AAAA-MM-DD', help='vencimento a partir de')
+    parser.add_argument('--to', dest='date_to', type=_date, metavar='AAAA-MM-DD', help='vencimento até')
+    if with_status:
+        parser.add_argument('--status', choices=[STATUS_FAILED, STATUS_DEAD_LETTERED],
+                            help='só os itens que falharam ou foram para a fila de mensagens mortas')
+        parser.add_argument('--include-unknown', action='store_true',
+                            help='com --status dead-lettered, inclui os itens com resultado desconhecido '
+                                 '(podem já ter sido entregues)')
+    parser.add_argument('--limit', type=int, help='máximo de itens processados')
+    parser.add_argument('--dry-run', action='store_true', help='só lista o que seria processado')
+
+
+def matches(args, phone, digital_line, due_on):
+    """ Confere os filtros --phone, --line, --from e --to """
+    if args.phone and phone not in {format_phone_number(value) for value in args.phone}:
+        return False
+    if args.line and _digits(digital_line) not in {_digits(value) for value in args.line}:
+        return False
+    if args.date_from and (due_on is None or due_on < args.date_from):
+        return False
+    if args.date_to and (due_on is None or due_on > args.date_to):
+        return False
+    return True
+
+
+def has_filters(args):
+    return any((args.phone, args.line, args.date_from, args.date_to, args.limit))
+
+
+def select_payments(payments, args):
+    selected = [payment for payment in payments if matches(args, payment.payer_phone, payment.digital_line, payment.due_on)]
+    return selected[:args.limit] if args.limit else selected
+
+
+def select_contacts(contacts, args):
+    selected = [contact for contact in contacts
+                if matches(args, contact.phone, contact.digital_line, parse_due_date(contact.due_date))]
+    return selected[:args.limit] if args.limit else selected
+
+
+def print_payments(payments):
+    for payment in payments:
+        print(f"{payment.due_date}\t{payment.payer_name}\t{payment.payer_phone}\t{payment.digital_line}")
+    print(f"{len(payments)} boletos.")
+
+
+def print_contacts(contacts):
+    for contact in contacts:
+        print(f"{contact.due_date}\t{contact.name}\t{contact.phone}\t{contact.digital_line}")
+    print(f"{len(contacts)} contatos.")
+
+
+def sendpulse_credentials():
+    client_id = os.getenv('SENDPULSE_CLIENT_ID')
+    client_secret = os.getenv('SENDPULSE_CLIENT_SECRET')
+    if not client_id or not client_secret:
+        logger.error('Variáveis de ambiente SENDPULSE_CLIENT_ID e SENDPULSE_CLIENT_SECRET não definidas')
+        sys.exit(1)
+    return client_id, client_secret
+
+
+def fetch(args, persist=True):
+    """ Busca os boletos deste bucket (só no intervalo de --from/--to, se informado) e retorna os filtrados.
+    Com persist, grava a lista do dia se não houver filtros, ou os filtrados em FILTERED_FETCH_FILE """
+    today = date.today()
+    payments = find_charge.get_monthly_payments(from_date=args.date_from, to_date=args.date_to)
+    selected = select_payments(find_charge.select_payments(payments, today), args)
+    if args.dry_run:
+        print_payments(selected)
+    elif persist and has_filters(args):
+        find_charge.save_payments(selected, today, FILTERED_FETCH_FILE)
+    elif persist:
+        find_charge.save_payments(selected, today)
+    return selected
+
+
+def dead_letter_entries(args, kind):
+    """ Itens da fila de mensagens mortas do tipo; sem --include-unknown, deixa de fora os de resultado desconhecido
+    (a SendPulse pode tê-los executado), como replay_dead_letter.py """
+    entries = [entry for entry in dead_letter.load() if entry['kind'] == kind]
+    unknown = [entry for entry in entries if entry.get('unknown_outcome')]
+    if unknown and not args.include_unknown:
+        logger.warning("%d itens com resultado desconhecido (a SendPulse pode tê-los executado) ignorados. "
+                       "Confira e use --include-unknown.", len(unknown))
+        entries = [entry for entry in entries if not entry.get('unknown_outcome')]
+    return entries
+
+
+def load_boletos(args):
+    """ Boletos a resolver: da lista do dia, do relatório de falhas ou da fila de mensagens mortas.
+    Retorna (boletos, {chave do boleto: id do item na fila de mensagens mortas}) """
+    if args.status == STATUS_DEAD_LETTERED:
+        entries = dead_letter_entries(args, dead_letter.KIND_CONTACT)
+        return [Payment.from_dict(entry['payload']) for entry in entries], {entry['key']: entry['id'] for entry in entries}
+
+    source = contact_manager.FAILED_FILE if args.status == STATUS_FAILED else storage.bucket_path('debitos', 'listDebit.json')
+    if not os.path.exists(source):
+        return [], {}
+    with open(source, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    if args.status == STATUS_FAILED:
+        data = [item['boleto'] for item in data]
+    return parse_payments(data), {}
+
+
+def resolve(args, boletos=None):
+    """ Resolve os contatos dos boletos filtrados e coloca os resolvidos na fila de envio. Retorna as chaves dos contatos """
+    dead_letter_ids = {}
+    if boletos is None:
+        boletos, dead_letter_ids = load_boletos(args)
+    selected = select_payments(boletos, args)
+    if args.dry_run or not selected:
+        print_payments(selected)
+        return set()
+
+    client_id, client_secret = sendpulse_credentials()
+    token = contact_manager.get_access_token(client_id, client_secret)
+    if not token:
+        sys.exit(1)
+
+    results = contact_manager.resolve_boletos(selected, token)
+    processed = [result for result in results if result.status == contact_manager.STATUS_PROCESSED]
+    send_queue.enqueue([result.contact for result in processed])
+
+    # Tira das origens o que foi resolvido agora
+    done = {result.payment.key for result in processed}
+    for key in done & dead_letter_ids.keys():
+        dead_letter.remove(dead_letter_ids[key])
+    if args.status == STATUS_FAILED and done:
+        with open(contact_manager.FAILED_FILE, 'r', encoding='utf-8') as file:
+            remaining = [item for item in json.load(file) if Payment.from_dict(item['boleto']).key not in done]
+        storage.write_json(contact_manager.FAILED_FILE, remaining)
+
+    negative_cache.save()
+    contact_index.save()
+    for result in results:
+        metrics.incr(f'dispatch.resolve.{result.status}')
+        if result.status != contact_manager.STATUS_PROCESSED:
+            print(f"{result.status}\t{result.payment.payer_name}\t{result.payment.payer_phone}\t{result.error or ''}")
+    print(f"{len(processed)} de {len(results)} boletos resolvidos e colocados na fila de envio.")
+    return {result.contact.key for result in processed}
+
+
+def send(args, keys=None):
+    """ Envia os contatos filtrados: da fila de envio, dos envios com falha ou da fila de mensagens mortas """
+    if keys is not None:
+        selected = [contact for contact in send_queue.pending() if contact.key in keys]
+    elif args.status == STATUS_FAILED:
+        selected = select_contacts([contact for contact, _, _ in send_queue.failed()], args)
+    elif args.status == STATUS_DEAD_LETTERED:
+        entries = {entry['key']: entry for entry in dead_letter_entries(args, dead_letter.KIND_SEND)}
+        selected = select_contacts([Contact.from_dict(entry['payload']) for entry in entries.values()], args)
+    else:
+        selected = select_contacts(send_queue.pending(), args)
+
+    if args.dry_run or not selected:
+        print_contacts(selected)
+        return 0
+
+    # Volta para a fila de envio o que vem das listas de falha
+    if keys is None and args.status == STATUS_FAILED:
+        send_queue.enqueue(selected)
+        send_queue.forget_failed(contact.key for contact in selected)
+    elif keys is None and args.status == STATUS_DEAD_LETTERED:
+        send_queue.enqueue(selected)
+        for contact in selected:
+            dead_letter.remove(entries[contact.key]['id'])
+
+    client_id, client_secret = sendpulse_credentials()
+    delivered = send_mensage.drain_queue(client_id, client_secret, keys={contact.key for contact in selected})
+    metrics.incr('dispatch.send.processed', delivered)
+    print(f"{delivered} de {len(selected)} contatos processados; {send_queue.size()} continuam na fila de envio.")
+    return delivered
+
+
+def run(args):
+    """ fetch + resolve + send só para os boletos filtrados (passados em memória, sem gravar arquivo) """
+    payments = fetch(args, persist=False)
+    if args.dry_run:
+        return
+    keys = resolve(args, payments)
+    if keys:
+        send(args, keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocessa uma etapa só para os boletos/contatos filtrados')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_filters(subparsers.add_parser('fetch', help='busca os boletos e grava a lista do dia'), with_status=False)
+    add_filters(subparsers.add_parser('resolve', help='resolve os contatos e os coloca na fila de envio'))
+    add_filters(subparsers.add_parser('send', help='envia os contatos da fila'))
+    add_filters(subparsers.add_parser('run', help='fetch + resolve + send'), with_status=False)
+    args = parser.parse_args()
+    if not hasattr(args, 'status'):
+        args.status = None
+        args.include_unknown = False
+
+    commands = {'fetch': fetch, 'resolve': resolve, 'send': send, 'run': run}
+    if args.dry_run:
+        commands[args.command](args)
+        return
+
+    # Não roda junto com o automaticRun do bucket (mesmos arquivos e filas)
+    try:
+        with run_lock.hold():
+            commands[args.command](args)
+    except storage.BucketLockedError as e:
+        logger.error("%s. Nada foi processado.", e)
+        sys.exit(1)
+    send_queue.close()
+    metrics.dump(METRICS_FILE, 'dispatch')
+
+
+if __name__ == "__main__":
+    profiling.run_stage('dispatch', main)
@@ -0,0 +1,66 @@
+import os
+import logging
+
+import metrics
+import suppression
+
+logger = logging.getLogger(__name__)
+
+# Configuração das regras (ALLOWED_STATUSES, ALLOW_MISSING_STATUS e MIN_AMOUNT no .env)
+DEFAULT_ALLOWED_STATUSES = 'PENDING'
+# Pagamentos sem ExternalStatus continuam recebendo mensagem, como antes das regras (ALLOW_MISSING_STATUS=0 descarta)
+DEFAULT_ALLOW_MISSING_STATUS = '1'
+DEFAULT_MIN_AMOUNT = 0
+
+
+# Regras: recebem o pagamento (models.Payment) e retornam o motivo da rejeição ou None
+def status_rule(payment):
+    if not payment.external_status:
+        if os.getenv('ALLOW_MISSING_STATUS', DEFAULT_ALLOW_MISSING_STATUS) == '1':
+            return None
+        logger.warning("Pagamento %s sem status descartado (ALLOW_MISSING_STATUS=0).", payment.key)
+        return 'sem status'
+    allowed = {status.strip() for status in os.getenv('ALLOWED_STATUSES', DEFAULT_ALLOWED_STATUSES).split(',')}
+    if payment.external_status not in allowed:
+        return f'status {payment.external_status}'
+    return None
+
+
+def make_suppression_rule(index):
+    """ Regra da lista de supressão (suppression.py), por telefone ou documento do pagador """
+    def suppression_rule(payment):
+        return index.reason_for(payment.payer_phone, payment.payer_document)
+    return suppression_rule
+
+
+def min_amount_rule(payment):
+    min_amount = float(os.getenv('MIN_AMOUNT', DEFAULT_MIN_AMOUNT))
+    if payment.amount is not None and payment.amount < min_amount:
+        return f'valor {payment.amount:.2f} abaixo do mínimo {min_amount:.2f}'
+    return None
+
+
+def default_rules():
+    return [status_rule, make_suppression_rule(suppression.load()), min_amount_rule]
+
+
+def filter_eligible(payments, rules=None):
+    """ Aplica as regras em lote. Retorna (elegíveis, rejeitados com motivo) """
+    rules = default_rules() if rules is None else rules
+    eligible = []
+    rejected = []
+
+    for payment in payments:
+        for rule in rules:
+            reason = rule(payment)
+            if reason:
+                rejected.append({'payment': payment, 'reason': reason})
+                break
+        else:
+            eligible.append(payment)
+
+    metrics.incr('eligibility.eligible', len(eligible))
+    metrics.incr('eligibility.rejected', len(rejected))
+    if rejected:
+        logger.info("Elegibilidade: %d pagamentos aceitos, %d descartados.", len(eligible), len(rejected))
+    return eligible, rejected
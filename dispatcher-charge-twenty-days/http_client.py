@@ -0,0 +1,191 @@
+import os
+import time
+import logging
+import threading
+import requests
+
+import cassette
+import concurrency
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Timeouts padrão (conexão, leitura) em segundos por endpoint.
+# Podem ser sobrescritos por variável de ambiente, ex.: TIMEOUT_SENDPULSE_SEND_TEMPLATE=5,30
+DEFAULT_TIMEOUTS = {
+    'clinicorp.payment_list': (5, 60),
+    'sendpulse.oauth': (5, 15),
+    'sendpulse.get_by_phone': (5, 15),
+    'sendpulse.list_contacts': (5, 60),
+    'sendpulse.create_contact': (5, 20),
+    'sendpulse.set_variable': (5, 15),
+    'sendpulse.send_template': (5, 30),
+    'sendpulse.flows_run': (5, 30),
+}
+FALLBACK_TIMEOUT = (5, 30)
+
+# Circuit breaker: abre após N falhas consecutivas e tenta novamente depois de RESET segundos
+# (CIRCUIT_FAILURE_THRESHOLD e CIRCUIT_RESET_TIMEOUT no .env)
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+STATE_GAUGE = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """ Chamada recusada porque o circuit breaker do serviço está aberto """
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+        metrics.set_gauge(f'{name}.circuit_state', STATE_GAUGE[self.state])
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker '%s': %s -> %s (falhas consecutivas: %d, disparos: %d)",
+                           self.name, self.state, state, self.failures, self.trips)
+            self.state = state
+            metrics.set_gauge(f'{self.name}.circuit_state', STATE_GAUGE[state])
+
+    def allow(self):
+        """ Indica se uma chamada pode ser feita agora """
+        with self._lock:
+            if self.state == STATE_OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                # Deixa passar uma chamada de teste
+                self._set_state(STATE_HALF_OPEN)
+                return True
+            if self.state == STATE_HALF_OPEN:
+                # Já existe uma chamada de teste em andamento
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(STATE_CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.failures >= self.failure_threshold):
+                self.trips += 1
+                self.opened_at = time.monotonic()
+                metrics.incr(f'{self.name}.circuit_trips')
+                self._set_state(STATE_OPEN)
+
+    @property
+    def is_open(self):
+        return self.state == STATE_OPEN
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(service):
+    """ Retorna o circuit breaker do serviço (clinicorp, sendpulse) """
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(
+                service,
+                int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)),
+                float(os.getenv('CIRCUIT_RESET_TIMEOUT', DEFAULT_RESET_TIMEOUT))
+            )
+        return _breakers[service]
+
+
+def get_timeout(endpoint):
+    """ Retorna a tupla (conexão, leitura) configurada para o endpoint """
+    env_value = os.getenv('TIMEOUT_' + endpoint.replace('.', '_').upper())
+    if env_value:
+        try:
+            connect, read = (float(value) for value in env_value.split(','))
+            return connect, read
+        except ValueError:
+            logger.error("Valor inválido para timeout de %s: %s", endpoint, env_value)
+    return DEFAULT_TIMEOUTS.get(endpoint, FALLBACK_TIMEOUT)
+
+
+def is_failure_status(status_code):
+    """ Respostas que indicam problema no serviço (e não na requisição) """
+    return status_code == 429 or status_code >= 500
+
+
+def _send(endpoint, method, url, kwargs):
+    """ Executa a chamada na rede ou a partir da gravação (HTTP_CASSETTE_MODE) """
+    started = time.monotonic()
+    try:
+        if cassette.is_replaying():
+            return cassette.replay(endpoint, method, url, kwargs)
+        try:
+            response = requests.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if cassette.is_recording():
+                cassette.record(endpoint, method, url, kwargs, time.monotonic() - started, error=e)
+            raise
+        if cassette.is_recording():
+            cassette.record(endpoint, method, url, kwargs, time.monotonic() - started, response=response)
+        return response
+    finally:
+        # Tempo de espera de rede (usado no relatório de --profile)
+        metrics.incr('http.calls')
+        metrics.incr('http.wait_seconds', time.monotonic() - started)
+
+
+def request(endpoint, method, url, **kwargs):
+    """ Faz uma requisição HTTP com timeout explícito passando pelo circuit breaker do serviço
+    e, se configurado, pelo limite adaptativo de chamadas simultâneas (concurrency.py) """
+    service = endpoint.split('.')[0]
+    breaker = get_breaker(service)
+
+    if not breaker.allow():
+        metrics.incr(f'{service}.circuit_rejected')
+        raise CircuitOpenError(f"Circuit breaker '{service}' aberto. Chamada para {endpoint} não realizada.")
+
+    kwargs.setdefault('timeout', get_timeout(endpoint))
+    metrics.incr(f'{endpoint}.requests')
+
+    limiter = concurrency.get_limiter(service)
+    queued = time.monotonic()
+    if limiter is not None:
+        limiter.acquire()
+    started = time.monotonic()
+    overloaded = False
+    try:
+        with tracing.span(f'HTTP {method}', **{'http.method': method, 'http.endpoint': endpoint,
+                                               'concurrency.wait_ms': round((started - queued) * 1000, 3)}) as current:
+            response = _send(endpoint, method, url, kwargs)
+            if current is not None:
+                current.set_attribute('http.status_code', response.status_code)
+                if response.status_code >= 400:
+                    current.status = 'ERROR'
+        overloaded = is_failure_status(response.status_code)
+    except requests.exceptions.RequestException as e:
+        overloaded = isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+        metrics.incr(f'{endpoint}.errors')
+        breaker.record_failure()
+        raise
+    finally:
+        if limiter is not None:
+            limiter.release(time.monotonic() - started, overloaded)
+
+    if is_failure_status(response.status_code):
+        metrics.incr(f'{endpoint}.errors')
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
@@ -0,0 +1,36 @@
+import threading
+from datetime import datetime
+
+import storage
+
+# Contadores e medidores do processo atual (um arquivo por etapa ao final da execução)
+_counters = {}
+_gauges = {}
+_lock = threading.Lock()
+
+
+def incr(name, value=1):
+    """ Incrementa um contador """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """ Define o valor atual de um medidor """
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot():
+    """ Retorna uma cópia dos contadores e medidores atuais """
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges)}
+
+
+def dump(filename, stage):
+    """ Salva as métricas da etapa em JSON """
+    data = snapshot()
+    data['stage'] = stage
+    data['timestamp'] = datetime.now().isoformat(timespec='seconds')
+
+    storage.write_json(filename, data)
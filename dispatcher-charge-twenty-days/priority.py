@@ -0,0 +1,52 @@
+import os
+from datetime import date
+
+import send_history
+from models import parse_due_date
+
+# Ordem de atendimento: maior pontuação primeiro. Pesos no .env:
+#   PRIORITY_WEIGHT_DAYS          por dia de atraso (padrão 1)
+#   PRIORITY_WEIGHT_AMOUNT        por R$ 100 do boleto (padrão 1)
+#   PRIORITY_BUCKET_WEIGHT        peso fixo deste bucket (padrão 0)
+#   PRIORITY_WEIGHT_PRIOR_SENDS   por lembrete já enviado para o boleto (padrão -5: quem nunca recebeu vem antes)
+DEFAULT_WEIGHTS = {
+    'PRIORITY_WEIGHT_DAYS': 1.0,
+    'PRIORITY_WEIGHT_AMOUNT': 1.0,
+    'PRIORITY_BUCKET_WEIGHT': 0.0,
+    'PRIORITY_WEIGHT_PRIOR_SENDS': -5.0
+}
+
+
+def weights():
+    return {name: float(os.getenv(name, default)) for name, default in DEFAULT_WEIGHTS.items()}
+
+
+def score(days_overdue, amount, prior_sends, config=None):
+    config = config or weights()
+    return (config['PRIORITY_WEIGHT_DAYS'] * (days_overdue or 0)
+            + config['PRIORITY_WEIGHT_AMOUNT'] * (amount or 0) / 100
+            + config['PRIORITY_BUCKET_WEIGHT']
+            + config['PRIORITY_WEIGHT_PRIOR_SENDS'] * prior_sends)
+
+
+def _rank(records, days_overdue, today):
+    config = weights()
+    counts = send_history.sent_counts(record.boleto_key for record in records)
+    scored = [(score(days_overdue(record, today), record.amount, counts.get(record.boleto_key, 0), config), index, record)
+              for index, record in enumerate(records)]
+    # Empate: mantém a ordem original (vencimento / chegada na fila)
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [record for _, _, record in scored]
+
+
+def rank_payments(payments, today=None):
+    """ Ordena os boletos (models.Payment) por prioridade """
+    return _rank(payments, lambda payment, day: payment.days_due(day), today or date.today())
+
+
+def rank_contacts(contacts, today=None):
+    """ Ordena os contatos da fila de envio (models.Contact) por prioridade """
+    def days_overdue(contact, day):
+        due_on = parse_due_date(contact.due_date)
+        return (day - due_on).days if due_on else None
+    return _rank(contacts, days_overdue, today or date.today())
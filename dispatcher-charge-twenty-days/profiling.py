@@ -0,0 +1,93 @@
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import argparse
+import tracemalloc
+from datetime import datetime
+
+import log_setup
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = storage.bucket_path('perfil')
+
+
+def parse_profile_args(argv=None):
+    """ Lê --profile e --profile-memory, deixando os demais argumentos para a etapa """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile', action='store_true', help='gera relatório cProfile e tempo de rede x CPU')
+    parser.add_argument('--profile-memory', action='store_true', help='inclui o pico de memória (tracemalloc)')
+    args, remaining = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args, remaining
+
+
+def run_stage(stage, func):
+    """ Executa a função principal da etapa, com perfil quando chamada com --profile """
+    args, remaining = parse_profile_args()
+    sys.argv = sys.argv[:1] + remaining
+
+    if not args.profile and not args.profile_memory:
+        try:
+            return func()
+        finally:
+            log_setup.log_summary(stage)
+
+    if args.profile_memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        memory = None
+        if args.profile_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:15]
+            tracemalloc.stop()
+            memory = {'current_bytes': current, 'peak_bytes': peak, 'top_allocations': [str(stat) for stat in top]}
+        write_report(stage, profiler, wall, cpu, memory)
+        log_setup.log_summary(stage)
+
+
+def write_report(stage, profiler, wall, cpu, memory=None):
+    """ Salva o .prof (para snakeviz/pstats), o resumo em texto e a divisão rede x CPU em JSON """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{stage}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+
+    profiler.dump_stats(base + '.prof')
+
+    text = io.StringIO()
+    stats = pstats.Stats(profiler, stream=text)
+    stats.sort_stats('cumulative').print_stats(40)
+    stats.sort_stats('tottime').print_stats(20)
+    with open(base + '.txt', 'w', encoding='utf-8') as file:
+        file.write(text.getvalue())
+
+    counters = metrics.snapshot()['counters']
+    summary = {
+        'stage': stage,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu, 3),
+        # Tempo fora da CPU (rede, disco, esperas de backoff)
+        'off_cpu_seconds': round(max(0.0, wall - cpu), 3),
+        # Soma das esperas HTTP de todas as threads (pode passar do tempo total quando há paralelismo)
+        'network_wait_seconds': round(counters.get('http.wait_seconds', 0.0), 3),
+        'http_calls': counters.get('http.calls', 0),
+        'memory': memory
+    }
+    storage.write_json(base + '-resumo.json', summary)
+
+    logger.info("Perfil de %s: %.2fs total, %.2fs CPU, %.2fs em espera de rede. Relatórios em %s.*",
+                stage, wall, cpu, summary['network_wait_seconds'], base)
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Distribui os envios ao longo da janela de entrega em vez de mandar tudo de uma vez.
+#   SEND_WINDOW               janela de entrega do dia, HH:MM-HH:MM (padrão 08:00-20:00)
+#   SEND_QUIET_HOURS          intervalos sem envio dentro da janela, separados por vírgula (ex.: 12:00-13:30)
+#   SEND_RATE_PER_MINUTE      cota de envios por minuto (padrão 30; 0 = sem limite)
+#   SEND_SPREAD_OVER_WINDOW   1 para espalhar a fila pelo restante da janela (padrão 0: envia na cota máxima)
+#   SEND_WAIT_FOR_WINDOW      1 para aguardar a abertura da janela / o fim do horário de silêncio (padrão 1);
+#                             com 0, ou se a janela do dia já fechou, o restante fica na fila para a próxima execução
+DEFAULT_WINDOW = '08:00-20:00'
+DEFAULT_RATE_PER_MINUTE = 30
+
+
+def parse_interval(text):
+    """ 'HH:MM-HH:MM' -> (time, time) """
+    start, end = (datetime.strptime(part.strip(), '%H:%M').time() for part in text.split('-'))
+    return start, end
+
+
+def parse_intervals(text):
+    return [parse_interval(part) for part in (text or '').split(',') if part.strip()]
+
+
+class SendSchedule:
+    """ Janela de entrega, horários de silêncio e cota por minuto """
+
+    def __init__(self, window, quiet_hours=(), rate_per_minute=0, spread=False):
+        self.window = window
+        self.quiet_hours = list(quiet_hours)
+        self.rate_per_minute = rate_per_minute
+        self.spread = spread
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            window=parse_interval(os.getenv('SEND_WINDOW', DEFAULT_WINDOW)),
+            quiet_hours=parse_intervals(os.getenv('SEND_QUIET_HOURS', '')),
+            rate_per_minute=float(os.getenv('SEND_RATE_PER_MINUTE', DEFAULT_RATE_PER_MINUTE)),
+            spread=os.getenv('SEND_SPREAD_OVER_WINDOW', '0') == '1'
+        )
+
+    def _at(self, now, moment):
+        return datetime.combine(now.date(), moment)
+
+    def is_open(self, now):
+        start, end = self.window
+        if not self._at(now, start) <= now < self._at(now, end):
+            return False
+        return not any(self._at(now, quiet_start) <= now < self._at(now, quiet_end) for quiet_start, quiet_end in self.quiet_hours)
+
+    def next_open(self, now):
+        """ Próximo instante de hoje em que a janela está aberta (now se já estiver), ou None se ela já fechou """
+        start, end = self.window
+        candidate = max(now, self._at(now, start))
+        # Avança para o fim de cada horário de silêncio em que o candidato cair
+        moved = True
+        while moved:
+            moved = False
+            for quiet_start, quiet_end in self.quiet_hours:
+                if self._at(now, quiet_start) <= candidate < self._at(now, quiet_end):
+                    candidate = self._at(now, quiet_end)
+                    moved = True
+        return candidate if candidate < self._at(now, end) else None
+
+    def open_seconds_left(self, now):
+        """ Tempo de envio que ainda resta hoje (janela menos horários de silêncio) """
+        start, end = self.window
+        begin, finish = max(now, self._at(now, start)), self._at(now, end)
+        total = max(0.0, (finish - begin).total_seconds())
+        for quiet_start, quiet_end in self.quiet_hours:
+            overlap = (min(finish, self._at(now, quiet_end)) - max(begin, self._at(now, quiet_start))).total_seconds()
+            total -= max(0.0, overlap)
+        return total
+
+    def interval(self, now, remaining):
+        """ Espaçamento entre dois envios: a cota por minuto e, se configurado, o restante da janela dividido pela fila """
+        interval = 60.0 / self.rate_per_minute if self.rate_per_minute > 0 else 0.0
+        if self.spread and remaining:
+            interval = max(interval, self.open_seconds_left(now) / (remaining + 1))
+        return interval
+
+
+def run(items, deliver, schedule=None, wait_for_window=None, deadline=None, now=datetime.now, sleep=time.sleep):
+    """ Entrega os itens respeitando a agenda. deliver(item) retorna False para interromper (ex.: circuit breaker aberto)
+    e None quando o item foi pulado sem envio (ex.: reservado por outro worker), sem gastar a cota.
+    Para antes de deadline (datetime), se informado. Retorna quantos itens foram entregues; os demais continuam na fila de quem chamou """
+    schedule = schedule or SendSchedule.from_env()
+    if wait_for_window is None:
+        wait_for_window = os.getenv('SEND_WAIT_FOR_WINDOW', '1') == '1'
+
+    delivered = 0
+    next_slot = now()
+    for index, item in enumerate(items):
+        # Cota: espera o próximo horário livre
+        current = now()
+        if deadline is not None and max(current, next_slot) >= deadline:
+            logger.warning("Tempo da execução esgotado. %d contatos ficam na fila para a próxima execução.", len(items) - index)
+            break
+        if next_slot > current:
+            sleep((next_slot - current).total_seconds())
+            current = now()
+
+        if not schedule.is_open(current):
+            opens_at = schedule.next_open(current)
+            if deadline is not None and opens_at is not None and opens_at >= deadline:
+                opens_at = None
+            if opens_at is None or not wait_for_window:
+                logger.warning("Fora da janela de envio. %d contatos ficam na fila para a próxima execução.", len(items) - index)
+                break
+            logger.info("Fora da janela de envio. Aguardando até %s.", opens_at.strftime('%H:%M'))
+            sleep((opens_at - current).total_seconds())
+            current = now()
+
+        result = deliver(item)
+        if result is False:
+            break
+        if result is None:
+            continue
+        delivered += 1
+        next_slot = current + timedelta(seconds=schedule.interval(current, len(items) - index - 1))
+
+    return delivered
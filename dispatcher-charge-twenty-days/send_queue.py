@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from datetime import datetime
+
+import storage
+from models import Contact
+
+# Fila de envio persistente (SQLite): o que não foi enviado numa execução (janela fechada,
+# cota, circuit breaker aberto, processo interrompido) continua na fila para a próxima.
+# Vários workers (processos da mesma máquina, ver send_worker.py) esvaziam a mesma fila: cada contato é reservado
+# por um lease antes do envio e só volta a ficar visível se o lease vencer sem o envio ter sido concluído. O send_mensage calcula o lease pelo pior caso de um envio
+# (tentativas, timeouts e esperas da política de retry); DEFAULT_LEASE_SECONDS vale só para quem não informa.
+# Os contatos são divididos em SEND_SHARDS shards pelo hash do telefone.
+# A fila é local da máquina: o modo WAL do SQLite usa memória compartilhada e não funciona em disco de rede
+# (NFS, SMB), cujo lock de arquivo também não é confiável. SEND_QUEUE_FILE deve apontar para um disco local.
+QUEUE_FILE = os.getenv('SEND_QUEUE_FILE') or storage.bucket_path('fila', 'send_queue.db')
+SEND_SHARDS = int(os.getenv('SEND_SHARDS', 8))
+DEFAULT_LEASE_SECONDS = 120
+
+_connection = None
+_lock = threading.Lock()
+
+
+def _connect():
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(QUEUE_FILE), exist_ok=True)
+        _connection = sqlite3.connect(QUEUE_FILE, timeout=30, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS send_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                enqueued_at TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                lease_owner TEXT,
+                lease_expires_at REAL
+            )""")
+        _connection.execute('CREATE INDEX IF NOT EXISTS send_queue_shard ON send_queue (shard, id)')
+        _connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        # Envios recusados pela SendPulse (erro permanente), guardados para reenvio seletivo (dispatch.py send --status failed)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS failed_sends (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                error TEXT,
+                failed_at TEXT NOT NULL
+            )""")
+    return _connection
+
+
+def shard_of(phone):
+    """ Shard do contato pelo hash do telefone (estável entre processos) """
+    return zlib.crc32(str(phone or '').encode('utf-8')) % SEND_SHARDS
+
+
+def enqueue(contacts):
+    """ Acrescenta os contatos ao fim da fila e retorna quantos eram novos.
+    Um contato que já está na fila mantém a posição e tem os dados e a data de entrada atualizados """
+    now = datetime.now().isoformat(timespec='seconds')
+    rows = [(contact.key, json.dumps(contact.to_dict(), ensure_ascii=False), now, shard_of(contact.phone)) for contact in contacts]
+    with _lock:
+        connection = _connect()
+        before = connection.execute('SELECT COUNT(*) FROM send_queue').fetchone()[0]
+        with connection:
+            connection.executemany(
+                'INSERT INTO send_queue (key, payload, enqueued_at, shard) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, enqueued_at = excluded.enqueued_at', rows)
+        return connection.execute('SELECT COUNT(*) FROM send_queue').fetchone()[0] - before
+
+
+def get_meta(name):
+    with _lock:
+        row = _connect().execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(name, value):
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute('INSERT INTO meta (name, value) VALUES (?, ?) '
+                               'ON CONFLICT(name) DO UPDATE SET value = excluded.value', (name, value))
+
+
+def pending(shards=None):
+    """ Contatos na fila (opcionalmente só dos shards informados), na ordem de chegada.
+    Inclui os reservados por outros workers: a reserva é conferida em claim() """
+    query, params = 'SELECT payload FROM send_queue', []
+    if shards is not None:
+        shards = list(shards)
+        query += f" WHERE shard IN ({','.join('?' * len(shards))})"
+        params = shards
+    with _lock:
+        rows = _connect().execute(query + ' ORDER BY id', params).fetchall()
+    return [Contact.from_dict(json.loads(payload)) for payload, in rows]
+
+
+def enqueued_at(key):
+    """ Quando o contato entrou (ou voltou) na fila, como datetime; None se ele saiu da fila """
+    with _lock:
+        row = _connect().execute('SELECT enqueued_at FROM send_queue WHERE key = ?', (key,)).fetchone()
+    return datetime.fromisoformat(row[0]) if row else None
+
+
+def claim(key, owner, lease_seconds=None):
+    """ Reserva o contato para este worker. Retorna False se outro worker tem um lease válido ou se o contato saiu da fila """
+    lease_seconds = lease_seconds or float(os.getenv('SEND_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+    now = time.time()
+    with _lock:
+        connection = _connect()
+        with connection:
+            # Um único UPDATE condicional: atômico também entre processos
+            cursor = connection.execute(
+                'UPDATE send_queue SET lease_owner = ?, lease_expires_at = ? '
+                'WHERE key = ? AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires_at < ?)',
+                (owner, now + lease_seconds, key, owner, now))
+    return cursor.rowcount == 1
+
+
+def release(key, owner):
+    """ Devolve o contato reservado à fila sem enviar (ex.: circuit breaker aberto) """
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute('UPDATE send_queue SET lease_owner = NULL, lease_expires_at = NULL '
+                               'WHERE key = ? AND lease_owner = ?', (key, owner))
+
+
+def _owned(owner):
+    """ Condição extra dos comandos feitos por um worker: só valem se o lease ainda for dele """
+    return (' AND lease_owner = ?', (owner,)) if owner is not None else ('', ())
+
+
+def remove(key, owner=None):
+    """ Tira o contato da fila (enviado, descartado ou movido para a fila de mensagens mortas).
+    Com owner, só remove se o lease ainda for desse worker; retorna False se outro worker assumiu o contato """
+    condition, params = _owned(owner)
+    with _lock:
+        connection = _connect()
+        with connection:
+            cursor = connection.execute('DELETE FROM send_queue WHERE key = ?' + condition, (key, *params))
+    return cursor.rowcount == 1
+
+
+def fail(key, error, owner=None):
+    """ Tira o contato da fila, guardando-o entre os envios com falha (com owner, como em remove) """
+    now = datetime.now().isoformat(timespec='seconds')
+    condition, params = _owned(owner)
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO failed_sends (key, payload, error, failed_at) '
+                               'SELECT key, payload, ?, ? FROM send_queue WHERE key = ?' + condition,
+                               (error, now, key, *params))
+            cursor = connection.execute('DELETE FROM send_queue WHERE key = ?' + condition, (key, *params))
+    return cursor.rowcount == 1
+
+
+def failed():
+    """ Envios com falha: [(contato, erro, data da falha)], mais antigos primeiro """
+    with _lock:
+        rows = _connect().execute('SELECT payload, error, failed_at FROM failed_sends ORDER BY failed_at').fetchall()
+    return [(Contact.from_dict(json.loads(payload)), error, failed_at) for payload, error, failed_at in rows]
+
+
+def forget_failed(keys):
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.executemany('DELETE FROM failed_sends WHERE key = ?', [(key,) for key in keys])
+
+
+def size():
+    with _lock:
+        return _connect().execute('SELECT COUNT(*) FROM send_queue').fetchone()[0]
+
+
+def close():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
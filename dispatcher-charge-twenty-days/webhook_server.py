@@ -0,0 +1,127 @@
+import os
+import hmac
+import sys
+import json
+import logging
+import ipaddress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from dotenv import load_dotenv
+
+import events
+import log_setup
+
+# Carrega as variáveis de ambiente
+load_dotenv()
+
+# Receptor local dos webhooks da SendPulse. Os eventos vão para o banco compartilhado pelos buckets
+# (events.EVENTS_FILE), então basta uma instância rodando, de qualquer um dos buckets.
+# Eventos falsos (resposta, não entregue) fariam o send_mensage pular lembretes reais, então o receptor só escuta
+# fora da máquina (ex.: atrás de um proxy/túnel para a SendPulse) se WEBHOOK_TOKEN estiver definido.
+#   WEBHOOK_HOST / WEBHOOK_PORT   endereço de escuta (padrão 127.0.0.1:8085)
+#   WEBHOOK_PATH                  caminho configurado na SendPulse (padrão /sendpulse/webhook)
+#   WEBHOOK_TOKEN                 exigido em ?token= ou no cabeçalho X-Webhook-Token (obrigatório fora do loopback)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8085))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/sendpulse/webhook')
+MAX_BODY_BYTES = 5 * 1024 * 1024
+
+log_setup.configure()
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _received_token(self, url):
+        return self.headers.get('X-Webhook-Token') or parse_qs(url.query).get('token', [''])[0]
+
+    def _authorized(self, received):
+        token = os.getenv('WEBHOOK_TOKEN')
+        if not token:
+            return True
+        return hmac.compare_digest(received.encode('utf-8'), token.encode('utf-8'))
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != WEBHOOK_PATH:
+            self._reply(404, {'error': 'not found'})
+            return
+        received = self._received_token(url)
+        if not received.isascii():
+            self._reply(400, {'error': 'invalid token'})
+            return
+        if not self._authorized(received):
+            self._reply(403, {'error': 'forbidden'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Comprimento negativo faria a leitura esperar até o cliente desconectar
+            self._reply(400, {'error': 'invalid content-length'})
+            return
+        if length > MAX_BODY_BYTES:
+            self._reply(413, {'error': 'payload too large'})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length) or b'null')
+        except ValueError:
+            self._reply(400, {'error': 'invalid json'})
+            return
+
+        # A SendPulse envia uma lista de eventos; aceita também um evento avulso
+        raw_events = payload if isinstance(payload, list) else [payload]
+        try:
+            stored = events.store(raw_events)
+        except events.InvalidEventError as e:
+            logger.warning('Webhook com evento inválido recusado: %s', e)
+            self._reply(400, {'error': 'invalid event', 'detail': str(e)})
+            return
+        logger.info('%s eventos recebidos do webhook', stored, extra={'sample': 'webhook_events'})
+        self._reply(200, {'stored': stored})
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    if not is_loopback(WEBHOOK_HOST) and not os.getenv('WEBHOOK_TOKEN'):
+        logger.error('WEBHOOK_HOST=%s aceita conexões de fora da máquina: defina WEBHOOK_TOKEN para escutar nesse endereço',
+                     WEBHOOK_HOST)
+        sys.exit(1)
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    logger.info('Recebendo webhooks da SendPulse em http://%s:%s%s', WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import argparse
+
+from run_all_buckets import find_buckets, run_buckets
+
+# Reprocessamento pontual em um ou mais buckets: repassa o subcomando e os filtros para o dispatch.py de cada bucket.
+#   python3 dispatcher.py --bucket ten-days resolve --status failed
+#   python3 dispatcher.py send --status dead-lettered --limit 20      (todos os buckets)
+# Veja python3 dispatcher-charge-<bucket>/dispatch.py --help para os subcomandos e filtros.
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocessa uma etapa nos buckets escolhidos', add_help=False)
+    parser.add_argument('--bucket', action='append',
+                        help='bucket (ex.: five-days ou dispatcher-charge-five-days; repetível; padrão: todos)')
+    args, remaining = parser.parse_known_args()
+
+    buckets = find_buckets()
+    if args.bucket:
+        wanted = {name if name.startswith('dispatcher-charge-') else 'dispatcher-charge-' + name for name in args.bucket}
+        unknown = wanted - {os.path.basename(bucket_dir) for bucket_dir in buckets}
+        if unknown:
+            print(f"Bucket desconhecido: {', '.join(sorted(unknown))}")
+            sys.exit(2)
+        buckets = [bucket_dir for bucket_dir in buckets if os.path.basename(bucket_dir) in wanted]
+
+    if not run_buckets(buckets, remaining, script='dispatch.py'):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import glob
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Executa o automaticRun.py de todos os buckets ao mesmo tempo.
+# Cada bucket grava só na própria pasta e tem seu próprio lock, então o tempo total
+# passa a ser o do bucket mais lento em vez da soma dos quatro.
+# Os argumentos (ex.: --profile) são repassados para cada automaticRun.py.
+
+# Caminho base (diretório onde este script está localizado)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+print_lock = threading.Lock()
+
+
+def find_buckets():
+    return sorted(os.path.dirname(path) for path in glob.glob(os.path.join(base_dir, 'dispatcher-charge-*', 'automaticRun.py')))
+
+
+def run_bucket(bucket_dir, extra_args=(), script='automaticRun.py'):
+    """ Roda o script (automaticRun.py por padrão) do bucket, prefixando cada linha da saída com o nome do bucket """
+    name = os.path.basename(bucket_dir)
+    started = time.perf_counter()
+    process = subprocess.Popen(['python3', os.path.join(bucket_dir, script), *extra_args],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+                               env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    for line in process.stdout:
+        with print_lock:
+            print(f"[{name}] {line}", end='', flush=True)
+    return_code = process.wait()
+    return name, return_code, time.perf_counter() - started
+
+
+def run_buckets(buckets, extra_args=(), script='automaticRun.py'):
+    """ Roda o script nos buckets em paralelo e mostra o tempo de cada um. Retorna False se algum falhou """
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(buckets) or 1) as executor:
+        results = list(executor.map(lambda bucket_dir: run_bucket(bucket_dir, extra_args, script), buckets))
+
+    for name, return_code, seconds in results:
+        status = 'ok' if return_code == 0 else f'exit code {return_code}'
+        print(f"{name}: {seconds:.2f}s ({status})")
+    print(f"Total: {time.perf_counter() - started:.2f}s")
+    return all(return_code == 0 for _, return_code, _ in results)
+
+
+def main():
+    if not run_buckets(find_buckets(), sys.argv[1:]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()